@@ -5,48 +5,170 @@ move game logic to another file. Ideally the API will be simple, concerned
 primarily with communication to/from the API's users."""
 
 
-import logging
-import endpoints
-from protorpc import remote, messages
-from google.appengine.api import memcache
-from google.appengine.api import taskqueue
-from google.appengine.ext import ndb
-
-from models import std_num_pairs
-from models import User, Game, Score, AverageScore
-from models import StringMessage, NewGameForm, GameForm, GameForms,\
-    MakeGuessForm, ScoreForms, UserRankingForm, GameHistoryForm
-from utils import get_by_urlsafe
+import startup
+
+with startup.phase('api_imports'):
+    import logging
+    from datetime import date, datetime
+    import endpoints
+    from protorpc import remote, messages
+    from google.appengine.api import datastore_errors
+    from google.appengine.api import oauth
+    from google.appengine.ext import ndb
+
+    from models import std_num_pairs, RESULT_NAMES, leaderboard_windows,\
+        window_id
+    from models import User, Game, Score, AverageScore, Leaderboard,\
+        GameStats, WindowScore, VersionConflict
+    from models import StringMessage, NewGameForm, GameForm, GameForms,\
+        NewGamesForm, NewGameResultForm, NewGameResultForms,\
+        MakeGuessesForm, GuessResultForm, GuessResultForms,\
+        HistoryEntryForm, GuessResult,\
+        MakeGuessForm, ScoreForms, UserRankingForm, GameHistoryForm,\
+        CacheStatsForm, ApiStatsForm, EndpointStatsForm, RpcStatsForm,\
+        SlowCallForm, GameStatsForm, DailyGamesForm, ReaperStatsForm,\
+        WindowRankingForm, StartupReportForm, StartupPhaseForm,\
+        StartupStatsForm
+    from utils import fetch_page, key_from_urlsafe, DEFAULT_PAGE_SIZE,\
+        MAX_PAGE_SIZE
+    from user_resolver import resolve_user, resolve_users
+    import game_cache
+    import instrumentation
+    from game_cache import GameCache
+    from instrumentation import instrumented
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
+NEW_GAMES_REQUEST = endpoints.ResourceContainer(NewGamesForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
         urlsafe_game_key=messages.StringField(1),)
+GET_GAME_VERSION_REQUEST = endpoints.ResourceContainer(
+        urlsafe_game_key=messages.StringField(1),
+        known_version=messages.IntegerField(2),
+        delta=messages.BooleanField(3),)
 MAKE_GUESS_REQUEST = endpoints.ResourceContainer(
     MakeGuessForm,
     urlsafe_game_key=messages.StringField(1),)
+MAKE_GUESSES_REQUEST = endpoints.ResourceContainer(
+    MakeGuessesForm,
+    urlsafe_game_key=messages.StringField(1),)
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
+USER_GAMES_REQUEST = endpoints.ResourceContainer(
+        user_name=messages.StringField(1),
+        page_size=messages.IntegerField(2),
+        cursor=messages.StringField(3),
+        keys_only=messages.BooleanField(4),)
+USER_PAGE_REQUEST = endpoints.ResourceContainer(
+        user_name=messages.StringField(1),
+        page_size=messages.IntegerField(2),
+        cursor=messages.StringField(3),)
+GAME_HISTORY_REQUEST = endpoints.ResourceContainer(
+        urlsafe_game_key=messages.StringField(1),
+        page_size=messages.IntegerField(2),
+        cursor=messages.StringField(3),)
+PAGE_REQUEST = endpoints.ResourceContainer(
+        page_size=messages.IntegerField(1),
+        cursor=messages.StringField(2),)
 HIGH_SCORES_REQUEST= endpoints.ResourceContainer(
         number_of_results=messages.IntegerField(1),
         )
+LEADERBOARD_REQUEST = endpoints.ResourceContainer(
+        window=messages.StringField(1),
+        date=messages.StringField(2),
+        number_of_results=messages.IntegerField(3),)
+WINDOW_RANK_REQUEST = endpoints.ResourceContainer(
+        window=messages.StringField(1),
+        user_name=messages.StringField(2),
+        date=messages.StringField(3),)
+GAME_STATS_REQUEST = endpoints.ResourceContainer(
+        days=messages.IntegerField(1),)
 
-MEMCACHE_MOVES_REMAINING = 'MOVES_REMAINING'
+# Most games new_games creates in one request
+MAX_NEW_GAMES = 5000
+# Most guesses make_guesses makes in one request
+MAX_GUESSES = 200
+MAX_REQUEST_ID_LENGTH = 100
+# Most days of games created get_game_stats reports
+MAX_STATS_DAYS = 31
 
 @endpoints.api(name='concentration_game', version='v1')
 class ConcentrationGameApi(remote.Service):
     """Game API"""
+    @staticmethod
+    def _resolve_user(user_name):
+        """Returns the ResolvedUser for user_name. Raises NotFoundException
+        if no such user exists."""
+        user = resolve_user(user_name)
+        if not user:
+            raise endpoints.NotFoundException(
+                    'A User with that name does not exist!')
+        return user
+
+    @staticmethod
+    def _window_day(window, day):
+        """Checks a leaderboard window type and returns the date, given as
+        YYYY-MM-DD or None for today, that selects one window of it"""
+        if window not in leaderboard_windows:
+            raise endpoints.BadRequestException(
+                'window should be one of %s' % ', '.join(leaderboard_windows))
+        if not day:
+            return date.today()
+        try:
+            return datetime.strptime(day, '%Y-%m-%d').date()
+        except ValueError:
+            raise endpoints.BadRequestException('date should be YYYY-MM-DD')
+
+    @staticmethod
+    def _play(request, guesses, respond, response_type):
+        """Makes guesses on the game of a make_guess or make_guesses
+        request with Game.play and returns the response. Conflicting and
+        repeatedly colliding updates raise ConflictException."""
+        if request.request_id and \
+                len(request.request_id) > MAX_REQUEST_ID_LENGTH:
+            raise endpoints.BadRequestException(
+                    'request_id should be at most %s characters' %
+                    MAX_REQUEST_ID_LENGTH)
+        game_key = key_from_urlsafe(request.urlsafe_game_key, Game)
+        try:
+            response = Game.play(game_key, guesses, respond, response_type,
+                                 expected_version=request.expected_version,
+                                 request_id=request.request_id,
+                                 cache=GameCache())
+        except VersionConflict as e:
+            raise endpoints.ConflictException(
+                    'The game was updated by another request and is now at '
+                    'version %s' % e.version)
+        except datastore_errors.TransactionFailedError:
+            raise endpoints.ConflictException(
+                    'The game is being updated by other requests, please retry')
+        if response is None:
+            raise endpoints.NotFoundException('Game not found!')
+        return response
+
+    @staticmethod
+    def _require_admin():
+        """Raises ForbiddenException unless the caller is an admin of the app"""
+        try:
+            if oauth.is_current_user_admin(endpoints.EMAIL_SCOPE):
+                return
+        except oauth.Error:
+            pass
+        raise endpoints.ForbiddenException('Only admins can do this')
+
     @endpoints.method(request_message=USER_REQUEST,
                       response_message=StringMessage,
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrumented
     def create_user(self, request):
         """Create a User. Requires a unique username"""
-        if User.query(User.name == request.user_name).get():
+        if not User.normalize_name(request.user_name):
+            raise endpoints.BadRequestException('A user name is required')
+        if resolve_user(request.user_name) or \
+                not User.create(request.user_name, request.email):
             raise endpoints.ConflictException(
                     'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
         return StringMessage(message='User {} created!'.format(
                 request.user_name))
 
@@ -55,173 +177,394 @@ class ConcentrationGameApi(remote.Service):
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @instrumented
     def new_game(self, request):
         """Creates new game"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
-            raise endpoints.NotFoundException(
-                    'A User with that name does not exist!')
+        user = self._resolve_user(request.user_name)
         if request.attempts < std_num_pairs:
             raise endpoints.BadRequestException('Number of attempts should be at least the number of cards, 52')
         try:
-            game = Game.new_game(user.key, request.attempts)
+            game = Game.new_game(user, request.attempts)
         except ValueError:
             raise endpoints.BadRequestException('Number of the pairs should be greater than 1')
-
-        # Use a task queue to update the average attempts remaining.
-        # This operation is not needed to complete the creation of a new game
-        # so it is performed out of sequence.
-        # taskqueue.add(url='/tasks/cache_average_attempts')
         return game.to_form('Good luck playing Concentration game!')
 
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+    @endpoints.method(request_message=NEW_GAMES_REQUEST,
+                      response_message=NewGameResultForms,
+                      path='games',
+                      name='new_games',
+                      http_method='POST')
+    @instrumented
+    def new_games(self, request):
+        """Creates many new games at once. Returns the game key or an error
+        for each requested game, in order."""
+        if len(request.items) > MAX_NEW_GAMES:
+            raise endpoints.BadRequestException(
+                    'At most %s games can be created at once' % MAX_NEW_GAMES)
+        users = resolve_users(item.user_name for item in request.items)
+
+        results = [NewGameResultForm(user_name=item.user_name)
+                   for item in request.items]
+        to_create = []
+        for item, result in zip(request.items, results):
+            if not users[item.user_name]:
+                result.error = 'A User with that name does not exist!'
+            elif item.attempts < std_num_pairs:
+                result.error = 'Number of attempts should be at least the number of pairs, %s' % std_num_pairs
+            else:
+                to_create.append((users[item.user_name], item.attempts, result))
+
+        games = Game.new_games([(user, attempts)
+                                for user, attempts, _ in to_create])
+        for (_, _, result), game in zip(to_create, games):
+            result.urlsafe_key = game.key.urlsafe()
+        return NewGameResultForms(items=results)
+
+    @endpoints.method(request_message=GET_GAME_VERSION_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrumented
     def get_game(self, request):
-        """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        """Return the current game state. A client polling the game can pass
+        the version it already has, to get only not_modified or, with delta
+        set, only the cards that changed."""
+        game = GameCache().get(request.urlsafe_game_key)
         if game:
-            return game.to_form('Time to start guessing the pairs!')
+            return game.to_versioned_form('Time to start guessing the pairs!',
+                                          request.known_version,
+                                          request.delta)
         else:
             raise endpoints.NotFoundException('Game not found!')
     
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_GAMES_REQUEST,
                       response_message=GameForms,
                       path='game/user/{user_name}',
                       name='get_user_games',
                       http_method='GET')
+    @instrumented
     def get_user_games(self, request):
-        """Returns all of an individual User's games"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
-            raise endpoints.NotFoundException(
-                    'A User with that name does not exist!')
-        games = Game.query(Game.user == user.key and Game.game_over == False)
-        return GameForms(items=[game.to_form() for game in games])
+        """Returns a page of an individual User's unfinished games. Only the
+        game summaries are read, or only the game keys if keys_only is set."""
+        user = self._resolve_user(request.user_name)
+        query = Game.query(Game.game_over == False, Game.user == user.key)
+        if request.keys_only:
+            keys, next_cursor = fetch_page(query, request.page_size,
+                                           request.cursor, keys_only=True)
+            return GameForms(urlsafe_keys=[key.urlsafe() for key in keys],
+                             next_cursor=next_cursor)
+        games, next_cursor = fetch_page(query, request.page_size,
+                                        request.cursor,
+                                        projection=Game.summary_properties)
+        return GameForms(items=[game.to_summary_form(user.name)
+                                for game in games],
+                         next_cursor=next_cursor)
     
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}/cancel',
                       name='cancel_game',
                       http_method='DELETE')
+    @instrumented
     def cancel_game(self, request):
-        """Cancel the requested game."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        """Cancel the requested game. The game is read and deleted in one
+        transaction, so a game finished by a concurrent guess is kept."""
+        game_key = key_from_urlsafe(request.urlsafe_game_key, Game)
+        game = Game.cancel(game_key)
 
         if not game:
             raise endpoints.NotFoundException('Game not found!')
         if game.game_over:
             return game.to_form('Cannot deleted finished game.')
 
-        game_form = game.to_form('This game is deleted.')
-        game.key.delete()
-        return game_form 
+        GameCache().delete(game_key)
+        GameStats.record_removed([game])
+        return game.to_form('This game is deleted.')
 
     @endpoints.method(request_message=MAKE_GUESS_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='make_guess',
                       http_method='PUT')
+    @instrumented
     def make_guess(self, request):
-        """Makes a guess. Returns a game state with message"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game.game_over:
-            return game.to_form('Game already over!')
+        """Makes a guess. Returns a game state with message. If
+        expected_version is given, the guess is only made if the game is
+        still at that version. A request retried with the same request_id
+        gets the first response instead of guessing again."""
+        def respond(game, outcomes):
+            if not outcomes:
+                return game.to_form('Game already over!')
+            return game.to_form(outcomes[0][2])
+        return self._play(request, [(request.guess1, request.guess2)],
+                          respond, GameForm)
 
-        if (request.guess1 < 0 or request.guess1 > std_num_pairs * 2 - 1) or\
-                (request.guess2 < 0 or request.guess2 > std_num_pairs * 2 -1):
-            return game.to_form('Card numbers needs to be between 0 and %s' % (2 * game.num_pairs - 1)) 
-
-        if request.guess1 == request.guess2:
-            return game.to_form('Two guesses need to be for different cards')
+    @endpoints.method(request_message=MAKE_GUESSES_REQUEST,
+                      response_message=GuessResultForms,
+                      path='game/{urlsafe_game_key}/guesses',
+                      name='make_guesses',
+                      http_method='PUT')
+    @instrumented
+    def make_guesses(self, request):
+        """Makes a sequence of guesses in order and saves the game once.
+        Stops at game over. Returns the outcome of each guess made and the
+        final game state. expected_version and request_id work as for
+        make_guess."""
+        if not request.guesses:
+            raise endpoints.BadRequestException('No guesses were given')
+        if len(request.guesses) > MAX_GUESSES:
+            raise endpoints.BadRequestException(
+                    'At most %s guesses can be made at once' % MAX_GUESSES)
 
-        return game.make_guess(request.guess1, request.guess2)
+        def respond(game, outcomes):
+            items = [GuessResultForm(guess1=guess1, guess2=guess2,
+                                     message=message, result=result)
+                     for guess1, guess2, message, result in outcomes]
+            message = items[-1].message if items else 'Game already over!'
+            return GuessResultForms(items=items, game=game.to_form(message))
+        return self._play(
+            request,
+            [(guess.guess1, guess.guess2) for guess in request.guesses],
+            respond, GuessResultForms)
 
-    @endpoints.method(response_message=ScoreForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @instrumented
     def get_scores(self, request):
-        """Return all scores"""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
+        """Return a page of all scores"""
+        scores, next_cursor = fetch_page(Score.query(), request.page_size,
+                                         request.cursor)
+        return Score.to_forms(scores, next_cursor=next_cursor)
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @instrumented
     def get_user_scores(self, request):
-        """Returns all of an individual User's scores"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
-            raise endpoints.NotFoundException(
-                    'A User with that name does not exist!')
-        scores = Score.query(Score.user == user.key)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        """Returns a page of an individual User's scores"""
+        user = self._resolve_user(request.user_name)
+        scores, next_cursor = fetch_page(Score.query(Score.user == user.key),
+                                         request.page_size, request.cursor)
+        return Score.to_forms(scores, next_cursor=next_cursor)
 
     @endpoints.method(request_message=HIGH_SCORES_REQUEST,
                       response_message=ScoreForms,
                       path='scores/highest',
                       name='get_high_scores',
                       http_method='GET')
+    @instrumented
     def get_high_scores(self, request):
         """Returns high scores. Number of scores returned is limited by an optional
         parameter, number_of_results"""
-        scores = Score.query(Score.won == True).order(-Score.score).fetch(limit=request.number_of_results)
+        entries = Leaderboard.get_board().entries[:request.number_of_results]
         
-        return ScoreForms(items=[score.to_form() for score in scores])
+        return ScoreForms(items=[entry.to_form() for entry in entries])
 
     @endpoints.method(request_message=USER_REQUEST,
                       response_message=UserRankingForm,
                       path='user/{user_name}/rank',
                       name='get_user_rankings',
                       http_method='GET')
+    @instrumented
     def get_user_rankings(self, request):
         """Get a user's ranking based on average score"""
-        user = User.query(User.name == request.user_name).get()
-        if not user:
+        user = self._resolve_user(request.user_name)
+
+        avg_score, rank = AverageScore.get_with_rank_async(user.key).get_result()
+        if not avg_score:
             raise endpoints.NotFoundException(
-                    'A User with that name does not exist!')
+                    'This User has not finished any games yet!')
 
-        avg_score = AverageScore.query(AverageScore.user == user.key).get()
-        rank = AverageScore.query(AverageScore.avg_score > avg_score.avg_score).count() + 1
-        
-        return UserRankingForm(user_name=request.user_name, rank=rank, score=avg_score.avg_score)
+        return UserRankingForm(user_name=user.name,
+                               rank=rank, score=avg_score.avg_score)
 
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+    @endpoints.method(request_message=LEADERBOARD_REQUEST,
+                      response_message=ScoreForms,
+                      path='leaderboards/{window}',
+                      name='get_leaderboard',
+                      http_method='GET')
+    @instrumented
+    def get_leaderboard(self, request):
+        """Returns the high scores of a daily, weekly or all time window. The
+        window is the one date falls into, today if not given. Number of
+        scores returned is limited by an optional parameter,
+        number_of_results"""
+        day = self._window_day(request.window, request.date)
+        board = Leaderboard.get_board(Leaderboard.name_for(request.window, day))
+        entries = board.entries[:request.number_of_results]
+        return ScoreForms(items=[entry.to_form() for entry in entries])
+
+    @endpoints.method(request_message=WINDOW_RANK_REQUEST,
+                      response_message=WindowRankingForm,
+                      path='leaderboards/{window}/user/{user_name}',
+                      name='get_user_window_rank',
+                      http_method='GET')
+    @instrumented
+    def get_user_window_rank(self, request):
+        """Get a user's rank by best score in a daily, weekly or all time
+        window. The window is the one date falls into, today if not given."""
+        day = self._window_day(request.window, request.date)
+        user = self._resolve_user(request.user_name)
+        wid = window_id(request.window, day)
+        window_score, rank = WindowScore.get_with_rank_async(
+            user.key, wid).get_result()
+        if not window_score:
+            raise endpoints.NotFoundException(
+                    'This User has not finished any games in this window!')
+        return WindowRankingForm(user_name=user.name, window=wid, rank=rank,
+                                 best_score=window_score.best_score,
+                                 games=window_score.games,
+                                 wins=window_score.wins)
+
+    @endpoints.method(request_message=GAME_STATS_REQUEST,
+                      response_message=GameStatsForm,
+                      path='stats/games',
+                      name='get_game_stats',
+                      http_method='GET')
+    @instrumented
+    def get_game_stats(self, request):
+        """Get the number of active games and their attempts remaining, the
+        number of games won and lost, and the games created on each of the
+        last days days, today first"""
+        days = request.days or 1
+        if not 1 <= days <= MAX_STATS_DAYS:
+            raise endpoints.BadRequestException(
+                'days should be between 1 and %s' % MAX_STATS_DAYS)
+        stats = GameStats.get(days)
+        form = GameStatsForm(
+            active_games=stats[GameStats.ACTIVE_GAMES],
+            attempts_remaining=stats[GameStats.ATTEMPTS_REMAINING],
+            wins=stats[GameStats.WINS],
+            losses=stats[GameStats.LOSSES],
+            games_per_day=[DailyGamesForm(date=str(day), games=games)
+                           for day, games in stats['games_per_day']])
+        if form.active_games > 0:
+            form.average_attempts_remaining = \
+                float(form.attempts_remaining) / form.active_games
+        return form
+
+    @endpoints.method(response_message=StringMessage,
+                      path='games/average_attempts',
+                      name='get_average_attempts_remaining',
+                      http_method='GET')
+    @instrumented
+    def get_average_attempts(self, request):
+        """Get the average attempts remaining of all active games"""
+        stats = GameStats.get()
+        if stats[GameStats.ACTIVE_GAMES] <= 0:
+            return StringMessage(message='There are no active games')
+        average = float(stats[GameStats.ATTEMPTS_REMAINING]) / \
+            stats[GameStats.ACTIVE_GAMES]
+        return StringMessage(
+            message='The average moves remaining is {:.2f}'.format(average))
+
+    @endpoints.method(response_message=CacheStatsForm,
+                      path='stats/game_cache',
+                      name='get_game_cache_stats',
+                      http_method='GET')
+    @instrumented
+    def get_game_cache_stats(self, request):
+        """Get the hit, miss and conflict counters of the game state cache"""
+        self._require_admin()
+        return CacheStatsForm(**game_cache.get_stats())
+
+    @endpoints.method(response_message=ReaperStatsForm,
+                      path='stats/reaper',
+                      name='get_reaper_stats',
+                      http_method='GET')
+    @instrumented
+    def get_reaper_stats(self, request):
+        """Get the throughput and backlog of the last finished run of the
+        abandoned game reaper"""
+        self._require_admin()
+        # Only admins call this, so the reaper is not loaded on startup
+        import reaper
+        stats = reaper.get_last_run()
+        if not stats:
+            raise endpoints.NotFoundException('The reaper has not run yet')
+        return ReaperStatsForm(**stats)
+
+    @endpoints.method(response_message=StartupStatsForm,
+                      path='stats/startup',
+                      name='get_startup_stats',
+                      http_method='GET')
+    @instrumented
+    def get_startup_stats(self, request):
+        """Get the cold start phases of the most recent instances of this
+        version of the app, oldest first"""
+        self._require_admin()
+        return StartupStatsForm(items=[
+            StartupReportForm(
+                version=report['version'], instance=report['instance'],
+                trigger=report['trigger'], total_ms=report['total_ms'],
+                phases=[StartupPhaseForm(**phase)
+                        for phase in report['phases']])
+            for report in startup.get_reports()])
+
+    @endpoints.method(response_message=ApiStatsForm,
+                      path='stats/api',
+                      name='get_api_stats',
+                      http_method='GET')
+    def get_api_stats(self, request):
+        """Get the number and time of calls and RPCs made by each endpoint,
+        and each endpoint's slowest calls"""
+        self._require_admin()
+        def rpc_forms(rpcs, rpc_ms=None):
+            if rpc_ms is not None:
+                rpcs = dict((kind, {'calls': count,
+                                    'total_ms': rpc_ms.get(kind, 0)})
+                            for kind, count in rpcs.items())
+            return [RpcStatsForm(rpc_type=kind, calls=rpc['calls'],
+                                 total_ms=int(rpc['total_ms']))
+                    for kind, rpc in sorted(rpcs.items())]
+        return ApiStatsForm(items=[
+            EndpointStatsForm(
+                endpoint=stats['endpoint'], calls=stats['calls'],
+                total_ms=stats['total_ms'], rpcs=rpc_forms(stats['rpcs']),
+                slowest=[SlowCallForm(duration_ms=call['duration_ms'],
+                                      rpcs=rpc_forms(call['rpcs'],
+                                                     call['rpc_ms']))
+                         for call in stats['slowest']])
+            for stats in instrumentation.get_stats()])
+
+    @endpoints.method(request_message=GAME_HISTORY_REQUEST,
                       response_message=GameHistoryForm,
                       path='game/{urlsafe_game_key}/history',
                       name='get_game_history',
                       http_method='GET')
+    @instrumented
     def get_game_history(self, request):
-        """Get a game's history"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-                
-        return GameHistoryForm(urlsafe_key=request.urlsafe_game_key, history=game.history)
-
-
-
-#    @endpoints.method(response_message=StringMessage,
-#                      path='games/average_attempts',
-#                      name='get_average_attempts_remaining',
-#                      http_method='GET')
-#    def get_average_attempts(self, request):
-#        """Get the cached average moves remaining"""
-#        return StringMessage(message=memcache.get(MEMCACHE_MOVES_REMAINING) or '')
-#
-#    @staticmethod
-#    def _cache_average_attempts():
-#        """Populates memcache with the average moves remaining of Games"""
-#        games = Game.query(Game.game_over == False).fetch()
-#        if games:
-#            count = len(games)
-#            total_attempts_remaining = sum([game.attempts_remaining
-#                                        for game in games])
-#            average = float(total_attempts_remaining)/count
-#            memcache.set(MEMCACHE_MOVES_REMAINING,
-#                         'The average moves remaining is {:.2f}'.format(average))
-
-
-api = endpoints.api_server([ConcentrationGameApi])
+        """Get a page of a game's history, oldest guess first"""
+        game = GameCache().get(request.urlsafe_game_key)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+
+        page_size = min(request.page_size or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+        try:
+            offset = int(request.cursor or 0)
+        except ValueError:
+            raise endpoints.BadRequestException('Invalid cursor')
+        if page_size < 1 or offset < 0:
+            raise endpoints.BadRequestException('Invalid page')
+        entries, next_offset = game.history_page(offset, page_size)
+
+        form = GameHistoryForm(urlsafe_key=request.urlsafe_game_key)
+        for guess1, guess2, result, timestamp in entries:
+            form.entries.append(HistoryEntryForm(
+                guess1=guess1, guess2=guess2, timestamp=timestamp,
+                result=GuessResult(result) if result in RESULT_NAMES else None))
+            form.history.append('(Guess: [{0}, {1}], Result: {2})'.format(
+                guess1, guess2, RESULT_NAMES.get(result)))
+        if next_offset is not None:
+            form.next_cursor = str(next_offset)
+        return form
+
+
+with startup.phase('api_server'):
+    api = endpoints.api_server([ConcentrationGameApi])
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+"""bench_api.py - Micro-benchmarks for the ConcentrationGameApi endpoints.
+
+Runs each endpoint against the App Engine testbed datastore and memcache
+stubs, seeded with a configurable number of users, games and scores, and
+reports latency percentiles and the number of API RPCs made per call. Results
+are written as JSON so that runs from different commits can be compared.
+
+Usage:
+    python benchmarks/bench_api.py --sdk ~/google-cloud-sdk/platform/google_appengine \\
+        --users 200 --games 5 --scores 20 --iterations 200 --output results.json
+
+Pass --baseline with the JSON results of another commit to print the change
+in p50 latency and RPCs per call.
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENDPOINTS = ('new_game', 'make_guess', 'get_scores', 'get_high_scores',
+             'get_user_rankings', 'get_user_games')
+
+
+def setup_sdk(sdk_path):
+    """Puts the App Engine SDK and the app on sys.path"""
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, APP_DIR)
+
+
+class Benchmark(object):
+    """Seeds the testbed stubs and times calls to the API methods"""
+    def __init__(self, args):
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import testbed
+
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(app_id='concentration-bench')
+        # Queries see writes immediately, like the strongly consistent
+        # lookups they are compared against.
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=APP_DIR)
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_mail_stub()
+        self.testbed.init_urlfetch_stub()
+
+        from google.appengine.api import apiproxy_stub_map
+        self.rpcs = collections.Counter()
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'bench_rpc_counter', self._count_rpc)
+
+        from api import ConcentrationGameApi
+        self.service = ConcentrationGameApi()
+        self.user_names = []
+        self.games = []
+
+    def _count_rpc(self, service, call, request, response):
+        self.rpcs['%s.%s' % (service, call)] += 1
+
+    def close(self):
+        self.testbed.deactivate()
+
+    def call(self, name, **fields):
+        """Calls an API method the way the endpoints server would"""
+        method = getattr(self.service, name)
+        return method(method.remote.request_type(**fields))
+
+    def seed(self):
+        """Creates the users, unfinished games and scores to benchmark with"""
+        from google.appengine.ext import ndb
+        from models import User, Game, Score, AverageScore, RankBucket
+        from models import std_num_pairs
+
+        args = self.args
+        for index in range(args.users):
+            name = 'player%d' % index
+            self.call('create_user', user_name=name,
+                      email='%s@example.com' % name)
+            self.user_names.append(name)
+
+        users = ndb.get_multi([User.key_for(name) for name in self.user_names])
+        scores = []
+        averages = []
+        for user in users:
+            for _ in range(args.games):
+                self.games.append(Game.new_game(user, std_num_pairs * 4).key)
+            user_scores = [self.random.random() for _ in range(args.scores)]
+            for value in user_scores:
+                scores.append(Score(user=user.key, user_name=user.name,
+                                    date=self._random_date(),
+                                    won=value > 0.2, score=value,
+                                    guesses=self.random.randint(26, 104)))
+            if user_scores:
+                averages.append(AverageScore(
+                    key=AverageScore.key_for(user.key), user=user.key,
+                    num_score=len(user_scores),
+                    avg_score=sum(user_scores) / len(user_scores)))
+        ndb.put_multi(scores)
+        ndb.put_multi(averages)
+        RankBucket.rebuild()
+
+    def _random_date(self):
+        from datetime import date, timedelta
+        return date.today() - timedelta(days=self.random.randint(0, 30))
+
+    def _make_guess_fields(self):
+        """Picks a live game and a pair of unmatched cards, matching about
+        half of the time so that some games are played to the end"""
+        from models import Game
+        while self.games:
+            game_key = self.random.choice(self.games)
+            game = game_key.get()
+            if game and not game.game_over:
+                break
+            self.games.remove(game_key)
+        else:
+            raise RuntimeError('Ran out of unfinished games, seed more games')
+        unmatched = [index for index in range(game.num_cards())
+                     if not game.is_matched(index)]
+        guess1 = self.random.choice(unmatched)
+        if self.random.random() < 0.5:
+            guess2 = next(index for index in unmatched if index != guess1 and
+                          game.card_value(index) == game.card_value(guess1))
+        else:
+            guess2 = self.random.choice([index for index in unmatched
+                                         if index != guess1])
+        return dict(urlsafe_game_key=game_key.urlsafe(),
+                    guess1=guess1, guess2=guess2)
+
+    def request_fields(self, endpoint):
+        """Returns the request fields for one call to an endpoint"""
+        user_name = self.random.choice(self.user_names)
+        if endpoint == 'new_game':
+            return dict(user_name=user_name, attempts=104)
+        if endpoint == 'make_guess':
+            return self._make_guess_fields()
+        if endpoint == 'get_high_scores':
+            return dict(number_of_results=20)
+        if endpoint in ('get_user_rankings', 'get_user_games'):
+            return dict(user_name=user_name)
+        return {}
+
+    def run(self, endpoint):
+        """Times iterations calls to one endpoint. Each call starts with an
+        empty ndb context cache, like a fresh request."""
+        from google.appengine.ext import ndb
+        latencies = []
+        rpcs = collections.Counter()
+        for _ in range(self.args.iterations):
+            fields = self.request_fields(endpoint)
+            ndb.get_context().clear_cache()
+            self.rpcs.clear()
+            start = time.time()
+            self.call(endpoint, **fields)
+            latencies.append((time.time() - start) * 1000)
+            rpcs.update(self.rpcs)
+        return summarize(latencies, rpcs, self.args.iterations)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def summarize(latencies, rpcs, iterations):
+    return {
+        'iterations': iterations,
+        'latency_ms': {
+            'mean': sum(latencies) / len(latencies),
+            'p50': percentile(latencies, 0.5),
+            'p90': percentile(latencies, 0.9),
+            'p99': percentile(latencies, 0.99),
+            'max': max(latencies),
+        },
+        'rpcs_per_call': dict((name, float(count) / iterations)
+                              for name, count in rpcs.items()),
+        'total_rpcs_per_call': float(sum(rpcs.values())) / iterations,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=APP_DIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    print('%-20s %9s %9s %9s %9s %7s' % ('endpoint', 'mean ms', 'p50 ms',
+                                         'p90 ms', 'p99 ms', 'rpcs'))
+    for endpoint in ENDPOINTS:
+        if endpoint not in results:
+            continue
+        result = results[endpoint]
+        latency = result['latency_ms']
+        print('%-20s %9.2f %9.2f %9.2f %9.2f %7.1f' % (
+            endpoint, latency['mean'], latency['p50'], latency['p90'],
+            latency['p99'], result['total_rpcs_per_call']))
+
+
+def print_comparison(baseline, results):
+    """Prints the change in p50 latency and RPCs per call from a baseline
+    report written by --output"""
+    print('\nCompared with %s (%s):' % (baseline.get('revision'),
+                                       baseline.get('time')))
+    print('%-20s %9s %9s %8s %7s %7s' % ('endpoint', 'old p50', 'new p50',
+                                         'change', 'old rpc', 'new rpc'))
+    for endpoint in ENDPOINTS:
+        if endpoint not in results or endpoint not in baseline['results']:
+            continue
+        old = baseline['results'][endpoint]
+        new = results[endpoint]
+        old_p50 = old['latency_ms']['p50']
+        new_p50 = new['latency_ms']['p50']
+        change = (new_p50 - old_p50) / old_p50 * 100 if old_p50 else 0.0
+        print('%-20s %9.2f %9.2f %+7.1f%% %7.1f %7.1f' % (
+            endpoint, old_p50, new_p50, change, old['total_rpcs_per_call'],
+            new['total_rpcs_per_call']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='path to the App Engine SDK (google_appengine)')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--games', type=int, default=5,
+                        help='unfinished games per user')
+    parser.add_argument('--scores', type=int, default=10,
+                        help='scores per user')
+    parser.add_argument('--iterations', type=int, default=100,
+                        help='calls per endpoint')
+    parser.add_argument('--endpoints', nargs='+', default=list(ENDPOINTS),
+                        choices=ENDPOINTS)
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed for data and requests')
+    parser.add_argument('--output', help='file to write JSON results to')
+    parser.add_argument('--baseline',
+                        help='JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+    if not args.sdk:
+        parser.error('pass --sdk or set APPENGINE_SDK')
+
+    setup_sdk(args.sdk)
+    bench = Benchmark(args)
+    try:
+        bench.seed()
+        results = dict((endpoint, bench.run(endpoint))
+                       for endpoint in args.endpoints)
+    finally:
+        bench.close()
+
+    print_results(results)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            print_comparison(json.load(baseline), results)
+    if args.output:
+        report = {
+            'revision': git_revision(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'config': dict((name, getattr(args, name)) for name in
+                           ('users', 'games', 'scores', 'iterations', 'seed')),
+            'results': results,
+        }
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
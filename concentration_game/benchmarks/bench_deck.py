@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+"""bench_deck.py - Uniformity check and throughput benchmark for deck.py.
+
+The uniformity check shuffles a small deck many times and runs a chi-square
+test on how often each distinct arrangement comes up, and on how often each
+card value lands in each position of a standard deck. It exits with a
+non-zero status if either test rejects uniformity. deck.py has no App Engine
+dependencies, so no SDK is needed.
+
+Usage:
+    python benchmarks/bench_deck.py --samples 200000 --decks 20000
+"""
+
+import argparse
+import collections
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from deck import generate_deck, generate_decks
+
+
+def chi_square(observed, expected):
+    return sum((count - expected) ** 2 / expected for count in observed)
+
+
+def chi_square_critical(degrees, z=3.09):
+    """Approximate upper critical value of the chi-square distribution
+    (Wilson-Hilferty). z=3.09 is a one-sided significance level of 0.001."""
+    k = float(degrees)
+    return k * (1 - 2 / (9 * k) + z * math.sqrt(2 / (9 * k))) ** 3
+
+
+def arrangement_test(samples, seed):
+    """Shuffles a 3 pair deck, which has 6!/2**3 = 90 distinct arrangements,
+    and tests that they are equally likely"""
+    rng = random.Random(seed)
+    counts = collections.Counter(
+        tuple(generate_deck(3, rng.getrandbits(62))) for _ in range(samples))
+    arrangements = math.factorial(6) // 2 ** 3
+    observed = [counts.get(arrangement, 0) for arrangement in counts]
+    observed += [0] * (arrangements - len(counts))
+    return chi_square(observed, float(samples) / arrangements), \
+        chi_square_critical(arrangements - 1)
+
+
+def position_test(samples, seed, num_pairs=26):
+    """Tests that every card value is equally likely in every position"""
+    rng = random.Random(seed)
+    seeds = [rng.getrandbits(62) for _ in range(samples)]
+    counts = [[0] * num_pairs for _ in range(2 * num_pairs)]
+    for deck in generate_decks(num_pairs, seeds):
+        for position, value in enumerate(deck):
+            counts[position][value - 1] += 1
+    expected = float(samples) / num_pairs
+    statistic = sum(chi_square(row, expected) for row in counts)
+    # Each position has num_pairs - 1 degrees of freedom
+    return statistic, chi_square_critical(2 * num_pairs * (num_pairs - 1))
+
+
+def throughput(decks, num_pairs):
+    """Returns decks per second for single and batch generation"""
+    seeds = list(range(decks))
+    start = time.time()
+    for seed in seeds:
+        generate_deck(num_pairs, seed)
+    single = decks / (time.time() - start)
+    start = time.time()
+    generate_decks(num_pairs, seeds)
+    batch = decks / (time.time() - start)
+    return single, batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--samples', type=int, default=90000,
+                        help='shuffles per uniformity test')
+    parser.add_argument('--decks', type=int, default=20000,
+                        help='decks generated for the throughput benchmark')
+    parser.add_argument('--pairs', type=int, default=26)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    passed = True
+    for name, test in (('arrangements', arrangement_test),
+                       ('positions', position_test)):
+        statistic, critical = test(args.samples, args.seed)
+        ok = statistic < critical
+        passed = passed and ok
+        print('%-13s chi2 = %10.1f  critical = %10.1f  %s' % (
+            name, statistic, critical, 'ok' if ok else 'NOT UNIFORM'))
+
+    single, batch = throughput(args.decks, args.pairs)
+    print('%d pair decks: %.0f decks/s single, %.0f decks/s batch' % (
+        args.pairs, single, batch))
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
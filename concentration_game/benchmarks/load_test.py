@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+
+"""load_test.py - Concurrent end-to-end load generator for the game API.
+
+Runs simulated players on a thread pool against a running server, usually
+the local dev_appserver. Each player creates a user, then creates games with
+new_game and plays them to the end through make_guess, remembering the card
+values revealed by wrong guesses. The test is repeated at each concurrency
+level given, and for each level it reports the sustained guesses per second,
+latency percentiles per endpoint, and the error and contention (HTTP 409)
+rates. 409s are split into version conflicts, where another guess on the same
+game got in first, and transaction collisions. With --share, several players
+play each game at the same time, which measures how guesses on the same game
+contend. Finished games are ranked by a task that updates entities shared by
+all games, so after each level the players poll their all time window rank
+until it counts every game they finished, which measures how far contention
+on those entities holds the rankings back. It only talks HTTP, so no SDK is
+needed.
+
+Usage:
+    dev_appserver.py .
+    python benchmarks/load_test.py --url http://localhost:8080 \\
+        --levels 1 2 4 8 16 --duration 30 --output load.json
+"""
+
+import argparse
+import collections
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from multiprocessing.pool import ThreadPool
+
+try:
+    from urllib2 import Request, urlopen, HTTPError, URLError
+    from urllib import urlencode, quote
+except ImportError:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError, URLError
+    from urllib.parse import urlencode, quote
+
+API_PATH = '/_ah/api/concentration_game/v1/'
+ENDPOINTS = ('create_user', 'new_game', 'get_game', 'make_guess')
+WRONG_GUESS = re.compile(
+    r'Number for card (\d+) is (\d+) and for card (\d+) is (\d+)')
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+class ApiError(Exception):
+    """Raised for a failed API call. status is None if the server could not
+    be reached."""
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class Stats(object):
+    """Latencies and outcomes of the calls made at one concurrency level,
+    shared by all players"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.conflicts = collections.Counter()
+        self.collisions = collections.Counter()
+        self.guesses = 0
+        self.games = 0
+        # Games finished by the user who created them
+        self.finished = collections.Counter()
+
+    def record(self, endpoint, latency_ms, status, message=''):
+        with self._lock:
+            self.latencies[endpoint].append(latency_ms)
+            if status == 409 and 'being updated' in message:
+                self.collisions[endpoint] += 1
+            elif status == 409:
+                self.conflicts[endpoint] += 1
+            elif status is not None:
+                self.errors[endpoint] += 1
+
+    def count(self, guesses=0, games=0, owner=None):
+        with self._lock:
+            self.guesses += guesses
+            self.games += games
+            if owner:
+                self.finished[owner] += games
+
+    def summary(self, duration):
+        calls = sum(len(latencies) for latencies in self.latencies.values())
+        endpoints = {}
+        for endpoint, latencies in self.latencies.items():
+            endpoints[endpoint] = {
+                'calls': len(latencies),
+                'p50_ms': percentile(latencies, 0.5),
+                'p90_ms': percentile(latencies, 0.9),
+                'p99_ms': percentile(latencies, 0.99),
+                'errors': self.errors[endpoint],
+                'conflicts': self.conflicts[endpoint],
+                'collisions': self.collisions[endpoint],
+            }
+        return {
+            'duration_s': round(duration, 2),
+            'guesses': self.guesses,
+            'games_finished': self.games,
+            'guesses_per_s': self.guesses / duration if duration else 0.0,
+            'calls': calls,
+            'error_rate': float(sum(self.errors.values())) / calls
+                          if calls else 0.0,
+            'conflict_rate': float(sum(self.conflicts.values())) / calls
+                             if calls else 0.0,
+            'collision_rate': float(sum(self.collisions.values())) / calls
+                              if calls else 0.0,
+            'endpoints': endpoints,
+        }
+
+
+class Client(object):
+    """Calls the API over HTTP and records every call in stats"""
+    def __init__(self, base_url, stats, timeout):
+        self.base_url = base_url.rstrip('/') + API_PATH
+        self.stats = stats
+        self.timeout = timeout
+
+    def call(self, endpoint, method, path, params=None, body=None):
+        url = self.base_url + path
+        if params:
+            url += '?' + urlencode(params)
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        request = Request(url, data=data,
+                          headers={'Content-Type': 'application/json'})
+        request.get_method = lambda: method
+        status = None
+        message = ''
+        start = time.time()
+        try:
+            response = urlopen(request, timeout=self.timeout)
+            payload = response.read()
+            return json.loads(payload.decode('utf-8')) if payload else {}
+        except HTTPError as error:
+            status = error.code
+            message = error.read().decode('utf-8', 'replace')
+            raise ApiError(status, message)
+        except (URLError, IOError) as error:
+            status = 0
+            raise ApiError(None, str(error))
+        finally:
+            self.stats.record(endpoint, (time.time() - start) * 1000, status,
+                              message)
+
+
+class SharedGame(object):
+    """The game a group of players is playing. Every player plays its own
+    game unless --share puts several players on each game to measure
+    contention."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.key = None
+        self.owner = None
+
+    def next_game(self, player, finished_key=None):
+        """Returns the key of the game to play next, creating a new game
+        once the current one is finished"""
+        with self._lock:
+            if self.key is None or self.key == finished_key:
+                if finished_key:
+                    player.client.stats.count(games=1, owner=self.owner)
+                self.key = player.new_game()['urlsafe_key']
+                self.owner = player.name
+            return self.key
+
+
+class Player(object):
+    """A simulated player. Remembers the value of every card a wrong guess
+    revealed, guesses known pairs first, and otherwise turns over cards it
+    has not seen yet. Each guess carries the version of the game it was
+    made on and a request id. A guess rejected because the game changed
+    makes the player reload the game, and a guess that failed without an
+    answer is retried once with the same request id."""
+    def __init__(self, client, name, attempts, rng, shared):
+        self.client = client
+        self.name = name
+        self.attempts = attempts
+        self.random = rng
+        self.shared = shared
+
+    def create_user(self):
+        try:
+            self.client.call('create_user', 'POST', 'user',
+                             params={'user_name': self.name,
+                                     'email': '%s@example.com' % self.name})
+        except ApiError as error:
+            # The user is left over from an earlier run
+            if error.status != 409:
+                raise
+
+    def new_game(self):
+        return self.client.call('new_game', 'POST', 'game',
+                                body={'user_name': self.name,
+                                      'attempts': self.attempts})
+
+    def play_until(self, deadline):
+        finished = None
+        while time.time() < deadline:
+            try:
+                key = self.shared.next_game(self, finished)
+                finished = key if self.play(key, deadline) else None
+            except ApiError as error:
+                if error.status is None:
+                    # The server is down, back off instead of spinning
+                    time.sleep(1)
+
+    def play(self, key, deadline):
+        """Plays a game until it is over or the deadline passes. Returns
+        True if the game is over."""
+        path = 'game/' + quote(key)
+        game = self.client.call('get_game', 'GET', path)
+        if game['game_over']:
+            return True
+        unknown = []
+        self.reload(game, {}, unknown)
+        self.random.shuffle(unknown)
+        known = {}
+        version = int(game['version'])
+        while time.time() < deadline:
+            guess1, guess2 = self.choose(known, unknown)
+            body = {'guess1': guess1, 'guess2': guess2,
+                    'expected_version': version,
+                    'request_id': '%s-%s' % (self.name, uuid.uuid4().hex)}
+            try:
+                game = self.guess(path, body)
+            except ApiError as error:
+                if error.status != 409:
+                    raise
+                game = self.client.call('get_game', 'GET', path)
+                self.reload(game, known, unknown)
+            else:
+                if int(game['version']) > version:
+                    self.client.stats.count(guesses=1)
+                    self.learn(game['message'], guess1, guess2, known,
+                               unknown)
+            version = int(game['version'])
+            if game['game_over']:
+                return True
+        return False
+
+    def guess(self, path, body):
+        try:
+            return self.client.call('make_guess', 'PUT', path, body=body)
+        except ApiError as error:
+            if error.status is not None and error.status < 500:
+                raise
+            # The guess may have been made, so retry it under the same
+            # request id to get its response instead of guessing again
+            return self.client.call('make_guess', 'PUT', path, body=body)
+
+    def ranked_games(self):
+        """Returns the number of the player's games counted by the all time
+        leaderboard window"""
+        try:
+            rank = self.client.call(
+                'get_user_window_rank', 'GET',
+                'leaderboards/all/user/' + quote(self.name))
+        except ApiError as error:
+            if error.status != 404:
+                raise
+            return 0
+        return int(rank['games'])
+
+    @staticmethod
+    def reload(game, known, unknown):
+        """Forgets cards another player matched, going by the card layout
+        of a game. Fills an empty unknown with the cards not matched."""
+        layout = game['card_layout'].strip('[]').split(', ')
+        matched = set(index for index, card in enumerate(layout)
+                      if card == 'G')
+        for index in matched:
+            known.pop(index, None)
+        if not unknown:
+            unknown.extend(index for index in range(len(layout))
+                           if index not in matched and index not in known)
+        else:
+            unknown[:] = [index for index in unknown if index not in matched]
+
+    @staticmethod
+    def choose(known, unknown):
+        values = {}
+        for index, value in known.items():
+            if value in values:
+                return values[value], index
+            values[value] = index
+        if len(unknown) >= 2:
+            return unknown[0], unknown[1]
+        # One card is left unseen, so its pair is a known card
+        return unknown[0], next(iter(known))
+
+    @staticmethod
+    def learn(message, guess1, guess2, known, unknown):
+        """Updates what the player knows from a make_guess message"""
+        for index in (guess1, guess2):
+            if index in unknown:
+                unknown.remove(index)
+        match = WRONG_GUESS.search(message)
+        if match:
+            card1, value1, card2, value2 = map(int, match.groups())
+            known[card1] = value1
+            known[card2] = value2
+        else:
+            known.pop(guess1, None)
+            known.pop(guess2, None)
+
+
+def wait_for_ranking(players, finished, timeout):
+    """Polls the players' all time window ranks until they count every game
+    the players finished. Returns the number of games not ranked yet when
+    play stopped and the seconds it took to rank them all, or None if they
+    were not all ranked within timeout seconds."""
+    start = time.time()
+    pending = [player for player in players if finished[player.name]]
+    unranked = None
+    while True:
+        pending = [player for player in pending
+                   if player.ranked_games() < finished[player.name]]
+        if unranked is None:
+            unranked = sum(finished[player.name] for player in pending)
+        if not pending:
+            return unranked, time.time() - start
+        if time.time() - start > timeout:
+            return unranked, None
+        time.sleep(0.5)
+
+
+def run_level(args, level, run_id):
+    """Runs level players for args.duration seconds and returns the summary"""
+    stats = Stats()
+    games = [SharedGame() for _ in range(0, level, args.share)]
+    players = [Player(Client(args.url, stats, args.timeout),
+                      'load-%s-%d-%d' % (run_id, level, index), args.attempts,
+                      random.Random('%s-%d' % (args.seed, index)),
+                      games[index // args.share])
+               for index in range(level)]
+    pool = ThreadPool(level)
+    try:
+        pool.map(lambda player: player.create_user(), players)
+        # Users are created before the clock starts, so only the games count
+        stats.reset()
+        start = time.time()
+        deadline = start + args.duration
+        pool.map(lambda player: player.play_until(deadline), players)
+        duration = time.time() - start
+    finally:
+        pool.close()
+        pool.join()
+    summary = stats.summary(duration)
+    summary['players'] = level
+    summary['players_per_game'] = args.share
+    summary['unranked_at_end'], summary['ranking_lag_s'] = wait_for_ranking(
+        players, stats.finished, args.ranking_timeout)
+    return summary
+
+
+def print_results(results):
+    print('%7s %9s %8s %7s %9s %10s %9s %9s %9s %8s %9s' % (
+        'players', 'guesses/s', 'games', 'errors', 'conflicts',
+        'collisions', 'guess p50', 'guess p90', 'guess p99', 'unranked',
+        'rank lag'))
+    for result in results:
+        guess = result['endpoints'].get('make_guess', {})
+        lag = result['ranking_lag_s']
+        print('%7d %9.1f %8d %6.2f%% %8.2f%% %9.2f%% %9.1f %9.1f %9.1f '
+              '%8d %9s' % (
+                  result['players'], result['guesses_per_s'],
+                  result['games_finished'], result['error_rate'] * 100,
+                  result['conflict_rate'] * 100,
+                  result['collision_rate'] * 100, guess.get('p50_ms', 0),
+                  guess.get('p90_ms', 0), guess.get('p99_ms', 0),
+                  result['unranked_at_end'],
+                  'timeout' if lag is None else '%.1fs' % lag))
+    print('\n%7s %-20s %7s %9s %9s %9s %7s %9s %10s' % (
+        'players', 'endpoint', 'calls', 'p50 ms', 'p90 ms', 'p99 ms',
+        'errors', 'conflicts', 'collisions'))
+    for result in results:
+        for endpoint in ENDPOINTS:
+            if endpoint not in result['endpoints']:
+                continue
+            stats = result['endpoints'][endpoint]
+            print('%7d %-20s %7d %9.1f %9.1f %9.1f %7d %9d %10d' % (
+                result['players'], endpoint, stats['calls'], stats['p50_ms'],
+                stats['p90_ms'], stats['p99_ms'], stats['errors'],
+                stats['conflicts'], stats['collisions']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--url', default='http://localhost:8080',
+                        help='base URL of the server')
+    parser.add_argument('--levels', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='numbers of concurrent players to test with')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds to run each level for')
+    parser.add_argument('--attempts', type=int, default=104,
+                        help='attempts allowed per game')
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='seconds to wait for each call')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed for the players')
+    parser.add_argument('--share', type=int, default=1,
+                        help='players playing each game together, to '
+                             'measure contention on the same game')
+    parser.add_argument('--ranking-timeout', type=float, default=60,
+                        help='seconds to wait after each level for the '
+                             'finished games to be ranked')
+    parser.add_argument('--output', help='file to write JSON results to')
+    args = parser.parse_args()
+
+    run_id = time.strftime('%Y%m%d%H%M%S')
+    results = []
+    for level in args.levels:
+        results.append(run_level(args, level, run_id))
+        print('%d players: %.1f guesses/s' % (level,
+                                              results[-1]['guesses_per_s']))
+    print('')
+    print_results(results)
+    if args.output:
+        report = {
+            'url': args.url,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'config': dict((name, getattr(args, name)) for name in
+                           ('levels', 'duration', 'attempts', 'seed',
+                            'share', 'ranking_timeout')),
+            'results': results,
+        }
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
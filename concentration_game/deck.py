@@ -0,0 +1,50 @@
+"""deck.py - Generation of shuffled decks of card pairs. Decks are shuffled in
+linear time with a Fisher-Yates shuffle driven by a seed, so that a deck can
+be regenerated from its seed to replay or audit a game."""
+
+import random
+
+# Card values are stored one byte per card, see Game.cards
+MAX_NUM_PAIRS = 255
+SEED_BITS = 62
+
+_seed_source = random.SystemRandom()
+
+
+def new_seed():
+    """Returns a random seed that fits in an IntegerProperty"""
+    return _seed_source.getrandbits(SEED_BITS)
+
+
+def _ordered_deck(num_pairs):
+    if num_pairs < 2:
+        raise ValueError('Number of the pairs should be greater than 1')
+    if num_pairs > MAX_NUM_PAIRS:
+        raise ValueError('Number of the pairs should be at most %s' %
+                         MAX_NUM_PAIRS)
+    return [value for value in range(1, num_pairs + 1) for _ in (0, 1)]
+
+
+def generate_deck(num_pairs, seed):
+    """Creates and returns a list with each integer from 1 to num_pairs twice,
+    shuffled. The same seed always gives the same deck on the same Python
+    runtime."""
+    deck = _ordered_deck(num_pairs)
+    # random.shuffle is an unbiased Fisher-Yates shuffle
+    random.Random(seed).shuffle(deck)
+    return deck
+
+
+def generate_decks(num_pairs, seeds):
+    """Creates and returns one deck per seed. Faster than calling
+    generate_deck for each seed, since the ordered deck is built once and one
+    generator is re-seeded for every deck."""
+    ordered = _ordered_deck(num_pairs)
+    generator = random.Random()
+    decks = []
+    for seed in seeds:
+        deck = ordered[:]
+        generator.seed(seed)
+        generator.shuffle(deck)
+        decks.append(deck)
+    return decks
@@ -0,0 +1,82 @@
+"""game_cache.py - Memcache cache of live Game state, keyed by the urlsafe Game
+key. Reads fall back to the datastore on a miss. Guesses are made in
+datastore transactions, which drop the cached game before they run and put
+the new state after they commit. Puts use memcache compare-and-set and never
+replace a newer version of a game, so that the cache cannot go back to an
+older state when concurrent requests finish out of order."""
+
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+
+from models import Game
+from utils import get_by_urlsafe, BufferedCounters
+
+MEMCACHE_PREFIX = 'game:'
+STAT_NAMES = ('hits', 'misses', 'conflicts')
+# Compare-and-set attempts made by put before it gives up and drops the entry
+PUT_ATTEMPTS = 3
+
+_stats = BufferedCounters('game_cache_stats:')
+
+
+def get_stats():
+    """Returns a dict of the hit, miss and conflict counters of all instances"""
+    return _stats.get_multi(STAT_NAMES)
+
+
+def _serialize(game):
+    return ndb.model_to_protobuf(game).Encode()
+
+
+def _deserialize(data):
+    return ndb.model_from_protobuf(entity_pb.EntityProto(data))
+
+
+class GameCache(object):
+    """Request-scoped access to the Game cache"""
+    def __init__(self):
+        self._client = memcache.Client()
+
+    def get(self, urlsafe):
+        """Returns the Game for a urlsafe key, or None if it does not exist"""
+        cache_key = MEMCACHE_PREFIX + urlsafe
+        data = self._client.get(cache_key)
+        if data is not None:
+            _stats.incr('hits')
+            return _deserialize(data)
+
+        _stats.incr('misses')
+        game = get_by_urlsafe(urlsafe, Game)
+        if game:
+            # add rather than set, so that a newer state put after our
+            # datastore read is not overwritten
+            self._client.add(cache_key, _serialize(game))
+        return game
+
+    def put(self, game):
+        """Writes a Game that was just stored to the cache, unless the cache
+        already holds the same or a newer version. If other requests keep
+        changing the entry, it is dropped and the next read reloads it."""
+        cache_key = MEMCACHE_PREFIX + game.key.urlsafe()
+        data = _serialize(game)
+        for _ in range(PUT_ATTEMPTS):
+            cached = self._client.gets(cache_key)
+            if cached is None:
+                if self._client.add(cache_key, data):
+                    return
+            elif _deserialize(cached).version >= game.version:
+                return
+            elif self._client.cas(cache_key, data):
+                return
+        _stats.incr('conflicts')
+        self._client.delete(cache_key)
+
+    def delete(self, game_key):
+        """Removes a Game from the cache"""
+        self._client.delete(MEMCACHE_PREFIX + game_key.urlsafe())
+
+    def delete_multi(self, game_keys):
+        """Removes several Games from the cache"""
+        self._client.delete_multi([MEMCACHE_PREFIX + key.urlsafe()
+                                   for key in game_keys])
@@ -0,0 +1,198 @@
+"""instrumentation.py - Counts and times the datastore and memcache RPCs made
+by each API method. Methods decorated with @instrumented collect the RPCs
+made while they run through apiproxy hooks, log one structured line per call
+and add to per-endpoint aggregates that get_api_stats reports."""
+
+import functools
+import heapq
+import json
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+import startup
+from utils import BufferedCounters
+
+RPC_TYPES = ('get', 'put', 'delete', 'query', 'count', 'transaction',
+             'memcache', 'other')
+# Number of slowest calls remembered per endpoint
+SLOWEST_CALLS = 5
+SLOWEST_PREFIX = 'api_slowest:'
+
+_DATASTORE_CALLS = {
+    'Get': 'get',
+    'Put': 'put',
+    'Delete': 'delete',
+    'RunQuery': 'query',
+    'Next': 'query',
+    'BeginTransaction': 'transaction',
+    'Commit': 'transaction',
+    'Rollback': 'transaction',
+}
+
+_aggregates = BufferedCounters('api_stats:', flush_every=20)
+_endpoints = set()
+_slowest_lock = threading.Lock()
+# Per endpoint, a min-heap of (duration_ms, call summary) for this instance
+_slowest = {}
+_local = threading.local()
+
+
+def rpc_type(service, call, request):
+    """Returns which of RPC_TYPES an API call is"""
+    if service == 'memcache':
+        return 'memcache'
+    if service != 'datastore_v3':
+        return 'other'
+    if call == 'RunQuery':
+        # ndb runs count() as a query that skips results without returning
+        # any of them.
+        try:
+            if request.has_limit() and request.limit() == 0 and \
+                    request.has_offset():
+                return 'count'
+        except AttributeError:
+            pass
+    return _DATASTORE_CALLS.get(call, 'other')
+
+
+class CallStats(object):
+    """RPCs made while one API method runs"""
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.start = time.time()
+        self.counts = dict.fromkeys(RPC_TYPES, 0)
+        self.rpc_ms = dict.fromkeys(RPC_TYPES, 0.0)
+        self._started = {}
+
+    def rpc_started(self, service, call, request, rpc):
+        kind = rpc_type(service, call, request)
+        self.counts[kind] += 1
+        self._started[id(rpc)] = (kind, time.time())
+
+    def rpc_finished(self, rpc):
+        kind, start = self._started.pop(id(rpc), (None, None))
+        if kind:
+            self.rpc_ms[kind] += (time.time() - start) * 1000
+
+    def summary(self, duration_ms):
+        return {
+            'endpoint': self.endpoint,
+            'duration_ms': round(duration_ms, 2),
+            'rpcs': dict((kind, count)
+                         for kind, count in self.counts.items() if count),
+            'rpc_ms': dict((kind, round(ms, 2))
+                           for kind, ms in self.rpc_ms.items() if ms),
+        }
+
+
+def _pre_call_hook(service, call, request, response, rpc=None):
+    stats = getattr(_local, 'stats', None)
+    if stats:
+        stats.rpc_started(service, call, request, rpc)
+
+
+def _post_call_hook(service, call, request, response, rpc=None, error=None):
+    stats = getattr(_local, 'stats', None)
+    if stats:
+        stats.rpc_finished(rpc)
+
+
+def install_hooks(apiproxy=None):
+    """Installs the RPC hooks. Called on import, and again by tools that
+    replace the apiproxy, such as testbed."""
+    apiproxy = apiproxy or apiproxy_stub_map.apiproxy
+    apiproxy.GetPreCallHooks().Append('api_instrumentation', _pre_call_hook)
+    apiproxy.GetPostCallHooks().Append('api_instrumentation', _post_call_hook)
+
+install_hooks()
+
+
+def instrumented(method):
+    """Decorator for remote.Service methods that records the RPCs they make.
+    Place it below @endpoints.method."""
+    endpoint = method.__name__
+    _endpoints.add(endpoint)
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        stats = _local.stats = CallStats(endpoint)
+        try:
+            return method(*args, **kwargs)
+        finally:
+            # Stop collecting before recording, so that the memcache calls
+            # made to record the stats are not counted themselves.
+            _local.stats = None
+            duration_ms = (time.time() - stats.start) * 1000
+            _record(stats, duration_ms)
+            if not startup.reported():
+                # No warmup request reached this instance first
+                startup.record('first_request', duration_ms)
+                startup.report(endpoint)
+    return wrapper
+
+
+def _record(stats, duration_ms):
+    summary = stats.summary(duration_ms)
+    logging.info('api_stats %s', json.dumps(summary, sort_keys=True))
+
+    deltas = {'%s.calls' % stats.endpoint: 1,
+              '%s.ms' % stats.endpoint: int(duration_ms)}
+    for kind in RPC_TYPES:
+        if stats.counts[kind]:
+            deltas['%s.%s.calls' % (stats.endpoint, kind)] = stats.counts[kind]
+            deltas['%s.%s.ms' % (stats.endpoint, kind)] = \
+                int(stats.rpc_ms[kind])
+    _aggregates.incr_multi(deltas)
+
+    with _slowest_lock:
+        slowest = _slowest.setdefault(stats.endpoint, [])
+        if len(slowest) >= SLOWEST_CALLS and duration_ms <= slowest[0][0]:
+            return
+        if len(slowest) >= SLOWEST_CALLS:
+            heapq.heapreplace(slowest, (duration_ms, summary))
+        else:
+            heapq.heappush(slowest, (duration_ms, summary))
+    # Slow calls are rare once the heap is full, so sharing them with other
+    # instances through memcache costs little.
+    _share_slow_call(stats.endpoint, summary)
+
+
+def _share_slow_call(endpoint, summary):
+    key = SLOWEST_PREFIX + endpoint
+    shared = memcache.get(key) or []
+    shared.append(summary)
+    shared.sort(key=lambda call: call['duration_ms'], reverse=True)
+    memcache.set(key, shared[:SLOWEST_CALLS])
+
+
+def get_stats():
+    """Returns a list of dicts with the aggregated calls, time and RPCs of
+    each instrumented endpoint and its slowest calls, most called first"""
+    names = []
+    for endpoint in _endpoints:
+        names += ['%s.calls' % endpoint, '%s.ms' % endpoint]
+        for kind in RPC_TYPES:
+            names += ['%s.%s.calls' % (endpoint, kind),
+                      '%s.%s.ms' % (endpoint, kind)]
+    counters = _aggregates.get_multi(names)
+    slowest = memcache.get_multi(list(_endpoints), key_prefix=SLOWEST_PREFIX)
+
+    stats = []
+    for endpoint in _endpoints:
+        stats.append({
+            'endpoint': endpoint,
+            'calls': counters['%s.calls' % endpoint],
+            'total_ms': counters['%s.ms' % endpoint],
+            'rpcs': dict((kind, {
+                'calls': counters['%s.%s.calls' % (endpoint, kind)],
+                'total_ms': counters['%s.%s.ms' % (endpoint, kind)]})
+                for kind in RPC_TYPES
+                if counters['%s.%s.calls' % (endpoint, kind)]),
+            'slowest': slowest.get(endpoint, []),
+        })
+    stats.sort(key=lambda endpoint: endpoint['calls'], reverse=True)
+    return stats
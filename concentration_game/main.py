@@ -2,23 +2,82 @@
 
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
-import logging
+import startup
 
-import webapp2
-from google.appengine.api import mail, app_identity
-from api import ConcentrationGameApi
+with startup.phase('main_imports'):
+    import json
+    import logging
+    import time
+    from datetime import datetime, timedelta
 
-from models import User, Game
+    import webapp2
+    from google.appengine.api import taskqueue
+    from google.appengine.ext import ndb
+
+    from models import Game, Score, RankBucket, Leaderboard, GameStats
+    from utils import fetch_page
+    import user_resolver
+
+REMINDER_PAGE_SIZE = 100
+# Format of the datetimes passed to tasks
+TASK_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
 
 
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
-        """Send a reminder email to each User with an incomplete games.
-        Called every hour using a cron job"""
+        """Start sending a reminder email to each User with incomplete games.
+        Called every hour using a cron job. The users are found and emailed
+        by a chain of ScanReminderUsers tasks."""
+        run_id = datetime.utcnow().strftime('%Y%m%d%H%M')
+        _add_named_task(taskqueue.Task(url='/tasks/reminders/scan',
+                                       params={'run_id': run_id, 'page': 0},
+                                       name='reminder-scan-%s-0' % run_id))
+
+
+class ScanReminderUsers(webapp2.RequestHandler):
+    def post(self):
+        """Find one page of users with incomplete games, enqueue a task that
+        emails them and enqueue a task for the next page. The cursor is
+        carried by the task, so a failed page is retried from where it
+        started instead of restarting the whole run."""
+        run_id = self.request.get('run_id')
+        page = int(self.request.get('page'))
+        # Only the indexed user property is read, with each user returned
+        # once, from the Game(game_over, user) index.
+        query = Game.query(Game.game_over == False, projection=[Game.user],
+                           distinct=True)
+        games, next_cursor = fetch_page(query, REMINDER_PAGE_SIZE,
+                                        self.request.get('cursor') or None)
+        user_keys = set(game.user for game in games)
+        tasks = []
+        if user_keys:
+            tasks.append(taskqueue.Task(
+                url='/tasks/reminders/send',
+                params={'users': ','.join(key.urlsafe() for key in user_keys)},
+                name='reminder-send-%s-%d' % (run_id, page)))
+        if next_cursor:
+            tasks.append(taskqueue.Task(
+                url='/tasks/reminders/scan',
+                params={'run_id': run_id, 'page': page + 1,
+                        'cursor': next_cursor},
+                name='reminder-scan-%s-%d' % (run_id, page + 1)))
+        else:
+            logging.info('Reminder run %s scanned %d pages', run_id, page + 1)
+        for task in tasks:
+            _add_named_task(task)
+        self.response.set_status(204)
+
+
+class SendReminders(webapp2.RequestHandler):
+    def post(self):
+        """Send a reminder email to each of a batch of users"""
+        from google.appengine.api import mail, app_identity
         app_id = app_identity.get_application_id()
-        users = User.query(User.email != None)
-        incomplete_game_users = [game.user for game in Game.query(Game.game_over == False)]
-        for user in [user for user in users if user.key in incomplete_game_users]:
+        user_keys = [ndb.Key(urlsafe=urlsafe)
+                     for urlsafe in self.request.get('users').split(',')]
+        for user in ndb.get_multi(user_keys):
+            if not user or not user.email:
+                continue
             subject = 'This is a reminder!'
             body = 'Hello {}, you still have incomplete Concentration game!'.format(user.name)
             # This will send test emails, the arguments to send_mail are:
@@ -27,16 +86,152 @@ class SendReminderEmail(webapp2.RequestHandler):
                            user.email,
                            subject,
                            body)
+        self.response.set_status(204)
+
+
+def _add_named_task(task):
+    """Adds a task, ignoring it if a task with the same name was already
+    added. Names make retried tasks safe to re-enqueue their successors."""
+    try:
+        task.add()
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+class RebuildRankIndex(webapp2.RequestHandler):
+    def get(self):
+        """Recompute the rank index from all AverageScores. Used to backfill
+        existing data or to repair the index."""
+        RankBucket.rebuild()
+        self.response.set_status(204)
+
+
+class RankScore(webapp2.RequestHandler):
+    def post(self):
+        """Add the Score of a game that just ended to the averages, rank
+        indexes and leaderboards. Enqueued by Game.end_game in the
+        transaction that ends the game, and retried by the task queue if
+        the update collides with other games ending."""
+        Score.rank(ndb.Key(urlsafe=self.request.get('score')))
+        self.response.set_status(204)
+
+
+class RecordGameStats(webapp2.RequestHandler):
+    def post(self):
+        """Add the deltas recorded by GameStats.record to the game
+        statistics counters"""
+        GameStats.apply(json.loads(self.request.get('deltas')))
+        self.response.set_status(204)
 
 
-# class UpdateAverageMovesRemaining(webapp2.RequestHandler):
-#     def post(self):
-#         """Update game listing announcement in memcache."""
-#         ConcentrationGameApi._cache_average_attempts()
-#         self.response.set_status(204)
+class RebuildLeaderboard(webapp2.RequestHandler):
+    def get(self):
+        """Rebuild the high score board from all Scores, to repair it"""
+        Leaderboard.rebuild()._cache()
+        self.response.set_status(204)
+
+
+class RunMigration(webapp2.RequestHandler):
+    def post(self, name):
+        """Migrate one page of entities, then enqueue a task for the next
+        page. Start a migration by enqueueing this task without a cursor."""
+        from migrations import MIGRATIONS
+        migration = MIGRATIONS.get(name)
+        if not migration:
+            self.abort(404)
+        next_cursor = migration(self.request.get('cursor') or None)
+        if next_cursor:
+            taskqueue.add(url=self.request.path,
+                          params={'cursor': next_cursor})
+        else:
+            logging.info('Migration %s finished', name)
+        self.response.set_status(204)
+
+
+class ReapAbandonedGames(webapp2.RequestHandler):
+    def get(self):
+        """Start archiving the unfinished games not played for ttl_days
+        days. Called daily using a cron job. The games are archived by a
+        chain of ReapGamesPage tasks."""
+        import reaper
+        ttl_days = int(self.request.get('ttl_days') or reaper.DEFAULT_TTL_DAYS)
+        now = datetime.utcnow()
+        cutoff = now - timedelta(days=ttl_days)
+        run_id = now.strftime('%Y%m%d%H%M')
+        _add_named_task(taskqueue.Task(
+            url='/tasks/reap_games',
+            params={'run_id': run_id, 'ttl_days': ttl_days, 'page': 0,
+                    'archived': 0, 'started': time.time(),
+                    'cutoff': cutoff.strftime(TASK_DATETIME_FORMAT)},
+            name='reap-games-%s-0' % run_id))
+
+
+class ReapGamesPage(webapp2.RequestHandler):
+    def post(self):
+        """Archive one page of idle games and enqueue a task for the next
+        page. The cursor and the run's totals are carried by the task, and
+        the run's stats are recorded once it runs out of games or pages."""
+        import reaper
+        params = self.request.params
+        run_id = params['run_id']
+        page = int(params['page'])
+        cutoff = datetime.strptime(params['cutoff'], TASK_DATETIME_FORMAT)
+        archived, next_cursor = reaper.reap_page(
+            cutoff, params.get('cursor') or None)
+        archived += int(params['archived'])
+        if next_cursor and page + 1 < reaper.MAX_RUN_PAGES:
+            _add_named_task(taskqueue.Task(
+                url='/tasks/reap_games',
+                params={'run_id': run_id, 'ttl_days': params['ttl_days'],
+                        'page': page + 1, 'archived': archived,
+                        'started': params['started'],
+                        'cutoff': params['cutoff'], 'cursor': next_cursor},
+                name='reap-games-%s-%d' % (run_id, page + 1)))
+        else:
+            reaper.record_run(run_id, int(params['ttl_days']),
+                              float(params['started']), page + 1, archived,
+                              reaper.count_backlog(cutoff))
+        self.response.set_status(204)
+
+
+class RebuildGameStats(webapp2.RequestHandler):
+    def get(self):
+        """Recount the global game statistics from the Games and Scores.
+        Used to backfill existing data or to repair the counters."""
+        GameStats.rebuild()
+        self.response.set_status(204)
+
+
+class Warmup(webapp2.RequestHandler):
+    def get(self):
+        """Load the API and prime the caches before the instance is sent
+        user requests, then report how long each phase of the cold start
+        took. Requested by App Engine when it starts a new instance."""
+        with startup.phase('warmup_api_server'):
+            # Builds the endpoints API server that serves /_ah/spi
+            import api
+        with startup.phase('warmup_datastore'):
+            Leaderboard.key_for(Leaderboard.HIGH_SCORES).get(
+                use_cache=False, use_memcache=False)
+        with startup.phase('warmup_leaderboard'):
+            board = Leaderboard.get_board()
+        with startup.phase('warmup_user_resolver'):
+            user_resolver.prime(entry.user_name for entry in board.entries)
+        startup.report('warmup')
+        self.response.set_status(204)
 
 
 app = webapp2.WSGIApplication([
+    ('/_ah/warmup', Warmup),
     ('/crons/send_reminder', SendReminderEmail),
-#    ('/tasks/cache_average_attempts', UpdateAverageMovesRemaining),
+    ('/tasks/reminders/scan', ScanReminderUsers),
+    ('/tasks/reminders/send', SendReminders),
+    ('/crons/reap_games', ReapAbandonedGames),
+    ('/tasks/reap_games', ReapGamesPage),
+    ('/tasks/rebuild_rank_index', RebuildRankIndex),
+    ('/tasks/rank_score', RankScore),
+    ('/tasks/record_game_stats', RecordGameStats),
+    ('/tasks/rebuild_leaderboard', RebuildLeaderboard),
+    ('/tasks/migrate/(\w+)', RunMigration),
+    ('/tasks/rebuild_game_stats', RebuildGameStats),
 ], debug=True)
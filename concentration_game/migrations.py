@@ -0,0 +1,171 @@
+"""migrations.py - Batched data migrations for changes to the Datastore
+entities. Each migration processes one page of entities and returns the cursor
+of the next page, so that main.py can run it as a chain of tasks which resumes
+from the last finished page if a task fails."""
+
+import collections
+import logging
+
+from google.appengine.ext import ndb
+
+from models import User, Game, Score, AverageScore, WindowScore, RankBucket,\
+    Leaderboard, leaderboard_windows, window_id
+from user_resolver import forget_user
+from utils import fetch_page, WriteBatch
+
+MIGRATION_PAGE_SIZE = 100
+
+
+def migrate_average_scores(cursor=None):
+    """Moves AverageScore rows stored under auto-allocated ids to the key
+    derived from their user. Rows for the same user are merged."""
+    avg_scores, next_cursor = fetch_page(AverageScore.query(),
+                                         MIGRATION_PAGE_SIZE, cursor)
+    for avg_score in avg_scores:
+        if avg_score.key != AverageScore.key_for(avg_score.user):
+            _move_average_score(avg_score.key)
+    return next_cursor
+
+
+@ndb.transactional(xg=True)
+def _move_average_score(old_key):
+    old = old_key.get()
+    if not old:
+        return
+    new_key = AverageScore.key_for(old.user)
+    new = new_key.get()
+    if new:
+        total = new.avg_score * new.num_score + old.avg_score * old.num_score
+        new.num_score += old.num_score
+        new.avg_score = total / new.num_score
+    else:
+        new = AverageScore(key=new_key, user=old.user,
+                           num_score=old.num_score, avg_score=old.avg_score)
+    # The rank index is rebuilt after the migration, so bucket counts are
+    # not adjusted here.
+    new.bucket = None
+    new.put()
+    old_key.delete()
+
+
+def migrate_users(cursor=None):
+    """Moves Users stored under auto-allocated ids to the key derived from
+    their name, and points their Games, Scores, AverageScore, WindowScores
+    and leaderboard entries at the new key. Safe to re-run: a User whose
+    move was interrupted is picked up again because the old entity is
+    deleted last, and the Scores, which tell which windows and boards to
+    update, are re-pointed after those."""
+    users, next_cursor = fetch_page(User.query(), MIGRATION_PAGE_SIZE, cursor)
+    for user in users:
+        if isinstance(user.key.id(), basestring):
+            continue
+        new_key = User.key_for(user.name)
+        existing = new_key.get()
+        if existing and existing.migrated_from != user.key:
+            logging.warning('Cannot migrate user %s: the name is taken by %s',
+                            user.key.id(), existing.name)
+            continue
+        if not existing:
+            User(key=new_key, name=user.name, email=user.email,
+                 migrated_from=user.key).put()
+
+        games = Game.query(Game.user == user.key).fetch()
+        scores = Score.query(Score.user == user.key).fetch()
+        window_ids = set(window_id(window, score.date)
+                         for score in scores for window in leaderboard_windows)
+        for wid in window_ids:
+            _move_window_score(wid, user.key, new_key)
+        board_names = set(Leaderboard.name_for(window, score.date)
+                          for score in scores if score.won
+                          for window in leaderboard_windows)
+        for name in board_names:
+            _repoint_leaderboard(name, user.key, new_key)
+
+        for entity in games + scores:
+            entity.user = new_key
+            entity.user_name = user.name
+        ndb.put_multi(games + scores)
+        old_avg_score = AverageScore.key_for(user.key).get()
+        if old_avg_score:
+            old_avg_score.user = new_key
+            old_avg_score.put()
+            _move_average_score(old_avg_score.key)
+
+        user.key.delete()
+        forget_user(user.name)
+    return next_cursor
+
+
+@ndb.transactional(xg=True)
+def _move_window_score(wid, old_user, new_user):
+    """Moves the WindowScore of old_user in the window with window id wid to
+    new_user, merging it into the one new_user may already have, and
+    adjusts the window's rank index"""
+    old, new = ndb.get_multi([WindowScore.key_for(wid, old_user),
+                              WindowScore.key_for(wid, new_user)])
+    if not old:
+        return
+    bucket_deltas = collections.Counter({old.bucket: -1})
+    if new:
+        bucket_deltas[new.bucket] -= 1
+        new.games += old.games
+        new.wins += old.wins
+        new.best_score = max(new.best_score, old.best_score)
+    else:
+        new = WindowScore(key=WindowScore.key_for(wid, new_user), window=wid,
+                          user=new_user, user_name=old.user_name,
+                          games=old.games, wins=old.wins,
+                          best_score=old.best_score)
+    new.bucket = RankBucket.bucket_for(new.best_score)
+    bucket_deltas[new.bucket] += 1
+
+    batch = WriteBatch()
+    batch.put(new)
+    changed = [b for b, delta in bucket_deltas.items() if delta]
+    keys = [RankBucket.key_for(b, wid) for b in changed]
+    for b, key, bucket in zip(changed, keys, ndb.get_multi(keys)):
+        bucket = bucket or RankBucket(key=key)
+        bucket.count += bucket_deltas[b]
+        batch.put(bucket)
+    batch.flush()
+    old.key.delete()
+
+
+@ndb.transactional
+def _repoint_leaderboard(name, old_user, new_user):
+    """Points the entries of old_user on the named Leaderboard at new_user"""
+    board = Leaderboard.key_for(name).get()
+    entries = [entry for entry in board.entries
+               if entry.user == old_user] if board else []
+    if not entries:
+        return
+    for entry in entries:
+        entry.user = new_user
+    board.put()
+    ndb.get_context().call_on_commit(board._cache)
+
+
+def migrate_game_last_modified(cursor=None):
+    """Sets last_modified on unfinished Games saved before it existed, so
+    that the reaper can find them. Their time to live starts now."""
+    games, next_cursor = fetch_page(Game.query(Game.game_over == False),
+                                    MIGRATION_PAGE_SIZE, cursor)
+    for game in games:
+        if game.last_modified is None:
+            _touch_game(game.key)
+    return next_cursor
+
+
+@ndb.transactional
+def _touch_game(game_key):
+    game = game_key.get()
+    if game and game.last_modified is None:
+        # last_modified is set by the put
+        game.put()
+
+
+MIGRATIONS = {
+    'average_scores': migrate_average_scores,
+    'users': migrate_users,
+    'game_last_modified': migrate_game_last_modified,
+}
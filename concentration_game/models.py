@@ -2,140 +2,1165 @@
 entities used by the Game. Because these classes are also regular Python
 classes they can include methods (such as 'to_form' and 'new_game')."""
 
+import json
+import logging
 import random
-from datetime import date
-from protorpc import messages
+import re
+import struct
+import time
+from datetime import date, timedelta
+from protorpc import messages, protojson
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
-from utils import generate_random_pairs
+from deck import generate_deck, generate_decks, new_seed
+from utils import WriteBatch
 
 # Make number of pairs as standard 26 pairs for ease of scoring and ranking purposes.
 std_num_pairs = 26
+# Number of entities written by each put_multi when creating games in bulk
+put_chunk_size = 500
+# Number of guesses stored in each HistoryChunk
+history_chunk_size = 64
+# Each history entry packs both guesses, the result and a timestamp
+history_entry = struct.Struct('<HHBI')
+# Number of CounterShards each counter is split over
+counter_shards = 20
+# Times a guess transaction that collided with another one is retried, and
+# the delay in seconds before the first retry, doubled for each retry after
+guess_retries = 3
+guess_backoff = 0.05
+
+
+class VersionConflict(Exception):
+    """Raised when guesses were made for another version of a Game than
+    the stored one"""
+    def __init__(self, version):
+        Exception.__init__(self, 'The game is at version %s' % version)
+        self.version = version
+
 
 class User(ndb.Model):
-    """User profile"""
+    """User profile. Keyed by the normalized user name."""
     name = ndb.StringProperty(required=True)
     email =ndb.StringProperty()
+    # Key of the auto-id User this entity was migrated from, if any
+    migrated_from = ndb.KeyProperty(kind='User', indexed=False)
+
+    @staticmethod
+    def normalize_name(name):
+        """User names are unique regardless of case and surrounding spaces"""
+        return (name or '').strip().lower()
+
+    @classmethod
+    def key_for(cls, name):
+        """Returns the key of the User with the given name"""
+        return ndb.Key(cls, cls.normalize_name(name))
+
+    @classmethod
+    @ndb.transactional
+    def create(cls, name, email=None):
+        """Creates and returns a new User, or returns None if a User with
+        that name already exists"""
+        key = cls.key_for(name)
+        if key.get():
+            return None
+        user = cls(key=key, name=name, email=email)
+        user.put()
+        return user
+
+
+def get_user_names(entities):
+    """Returns a dict mapping user keys to user names for the given Game or
+    Score entities. Names denormalized onto the entities are used as they are,
+    and the users of any remaining entities are resolved with a single
+    multi-get. ndb's per-request context cache acts as the identity map, so
+    a user that was already fetched in this request costs no further RPC."""
+    names = {}
+    missing = set()
+    for entity in entities:
+        if not entity.user:
+            continue
+        if entity.user_name:
+            names[entity.user] = entity.user_name
+        else:
+            missing.add(entity.user)
+    missing = [key for key in missing if key not in names]
+    for key, user in zip(missing, ndb.get_multi(missing)):
+        if user:
+            names[key] = user.name
+    return names
 
 
 class Game(ndb.Model):
     """Game object"""
-    pairs = ndb.IntegerProperty(repeated=True)
+    # Live games are cached by game_cache.GameCache instead
+    _use_memcache = False
+
+    # Card values packed one byte per card, and a bitset of matched cards
+    # with one bit per card. Both are unindexed blobs.
+    cards = ndb.BlobProperty()
+    matched = ndb.BlobProperty()
+    # Legacy card state with matched cards overwritten by -1. Converted to
+    # cards and matched the first time an old game is used.
+    pairs = ndb.IntegerProperty(repeated=True, indexed=False)
+    # Seed the deck was shuffled with, to replay or audit the game
+    seed = ndb.IntegerProperty(indexed=False)
+    # Incremented by every change to the game state
+    version = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    # Version at which each card was matched, packed as little-endian
+    # unsigned 32 bit integers. None until the first match.
+    match_versions = ndb.BlobProperty()
     guessed_pairs = ndb.IntegerProperty(required=True, default=0)
     attempts_allowed = ndb.IntegerProperty(required=True)
     attempts_remaining = ndb.IntegerProperty(required=True)
     game_over = ndb.BooleanProperty(required=True, default=False)
     user = ndb.KeyProperty(required=True, kind='User')
-    history = ndb.StringProperty(repeated=True)
+    # Denormalized from User so that listing games needs no user lookups
+    user_name = ndb.StringProperty(indexed=False)
+    # Guesses not yet moved to a HistoryChunk, packed with history_entry.
+    # Older guesses are in HistoryChunk children of the game.
+    history_tail = ndb.BlobProperty()
+    history_count = ndb.IntegerProperty(required=True, default=0,
+                                        indexed=False)
+    # Legacy history of formatted strings. Converted to history_tail the
+    # next time an old game is saved.
+    history = ndb.StringProperty(repeated=True, indexed=False)
+    # Time of the last write, used to find abandoned games
+    last_modified = ndb.DateTimeProperty(auto_now=True)
 
     @classmethod
-    def new_game(cls, user, attempts):
-        """Creates and returns a new game"""
-        # Make the game generate to standard 26 pairs for scoring and ranking purposes
-        game = Game(user=user,
-                    pairs=generate_random_pairs(std_num_pairs),
+    def new_game(cls, user, attempts, seed=None):
+        """Creates and returns a new game. user is a User or a ResolvedUser.
+        The deck is shuffled with seed, or with a new random seed."""
+        game = cls.build(user, attempts, seed)
+        game.put()
+        GameStats.record_created([game])
+        return game
+
+    @classmethod
+    def new_games(cls, users_and_attempts):
+        """Creates and returns new games for a list of (user, attempts)
+        tuples. The decks are generated in one batch and the games are
+        written in chunks of put_chunk_size, all chunks in parallel."""
+        seeds = [new_seed() for _ in users_and_attempts]
+        decks = generate_decks(std_num_pairs, seeds)
+        games = [cls.build(user, attempts, seed, deck)
+                 for (user, attempts), seed, deck
+                 in zip(users_and_attempts, seeds, decks)]
+        futures = []
+        for start in range(0, len(games), put_chunk_size):
+            futures += ndb.put_multi_async(
+                games[start:start + put_chunk_size], use_cache=False)
+        ndb.Future.wait_all(futures)
+        for future in futures:
+            future.check_success()
+        GameStats.record_created(games)
+        return games
+
+    @classmethod
+    def build(cls, user, attempts, seed=None, deck=None):
+        """Returns a new, unsaved game. deck may be passed in if it was
+        already generated from seed."""
+        if seed is None:
+            seed = new_seed()
+        if deck is None:
+            # Make the game generate to standard 26 pairs for scoring and ranking purposes
+            deck = generate_deck(std_num_pairs, seed)
+        game = Game(user=user.key,
+                    user_name=user.name,
+                    seed=seed,
                     attempts_allowed=attempts,
                     attempts_remaining=attempts,
                     game_over=False)
-        game.put()
+        game.set_cards(deck)
         return game
 
+    def verify_deck(self):
+        """Returns True if the cards are the deck generated from the game's
+        seed, or None for games created before seeds were stored"""
+        if self.seed is None:
+            return None
+        self._migrate_card_state()
+        deck = generate_deck(len(self.cards) // 2, self.seed)
+        return bytes(bytearray(deck)) == self.cards
+
+    def set_cards(self, values):
+        """Sets the card values of a new deck with no matched cards"""
+        self.cards = bytes(bytearray(values))
+        self.matched = bytes(bytearray((len(values) + 7) // 8))
+
+    def _migrate_card_state(self):
+        """Converts the legacy pairs list to the packed card state. Values of
+        cards matched in the legacy format are lost, and stored as 0."""
+        if self.cards is None and self.pairs:
+            pairs = self.pairs
+            self.set_cards([max(value, 0) for value in pairs])
+            self.pairs = []
+            for index, value in enumerate(pairs):
+                if value == -1:
+                    self._mark_matched(index)
+
+    def _pre_put_hook(self):
+        self._migrate_card_state()
+        self._migrate_history()
+
+    def num_cards(self):
+        self._migrate_card_state()
+        return len(self.cards)
+
+    def card_value(self, index):
+        self._migrate_card_state()
+        return ord(self.cards[index])
+
+    def is_matched(self, index):
+        self._migrate_card_state()
+        return bool(ord(self.matched[index // 8]) & (1 << (index % 8)))
+
+    def _mark_matched(self, index):
+        bits = bytearray(self.matched)
+        bits[index // 8] |= 1 << (index % 8)
+        self.matched = bytes(bits)
+
+    def _card_match_versions(self):
+        if not self.match_versions:
+            return [0] * len(self.cards)
+        return list(struct.unpack('<%dI' % len(self.cards),
+                                  self.match_versions))
+
+    def _set_match_version(self, indices):
+        """Records that the cards at indices were matched in this version"""
+        versions = self._card_match_versions()
+        for index in indices:
+            versions[index] = self.version
+        self.match_versions = struct.pack('<%dI' % len(versions), *versions)
+
+    def changed_cards(self, since_version):
+        """Returns the indices of cards matched after since_version"""
+        self._migrate_card_state()
+        return [index for index, version
+                in enumerate(self._card_match_versions())
+                if version > since_version]
+
     def card_layout(self):
         # Represent remaining cards as * and guessed cards as G
-        layout = []
-        for card in self.pairs:
-            layout.append('G' if card == -1 else '*')
+        self._migrate_card_state()
+        bits = bytearray(self.matched)
+        layout = ['G' if bits[index // 8] & (1 << (index % 8)) else '*'
+                  for index in range(len(self.cards))]
         # Represent the layout in string
         return '[' + ', '.join(layout) + ']'
 
-    def to_form(self, message=""):
+    def to_form(self, message="", user_name=None):
         """Returns a GameForm representation of the Game"""
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.user.get().name
+        form.user_name = user_name or self.user_name or self.user.get().name
         form.attempts_remaining = self.attempts_remaining
         form.game_over = self.game_over
         form.message = message
         form.card_layout = self.card_layout()
+        form.version = self.version
+        if self.game_over:
+            # Only revealed once the game is over, since the seed gives away
+            # the deck
+            form.seed = self.seed
         return form
 
-    def make_guess(self, guess1, guess2):
-        number1 = self.pairs[guess1] 
-        number2 = self.pairs[guess2]
+    def to_versioned_form(self, message, known_version=None, delta=False):
+        """Returns a GameForm for a client that already has known_version of
+        the game. If that is the current version, only not_modified and the
+        small fields are set. If delta is True, card_layout is replaced by
+        changed_cards, the cards matched since known_version."""
+        if known_version is None or known_version > self.version:
+            return self.to_form(message)
+        form = GameForm(urlsafe_key=self.key.urlsafe(),
+                        user_name=self.user_name or self.user.get().name,
+                        attempts_remaining=self.attempts_remaining,
+                        game_over=self.game_over, version=self.version)
+        if known_version == self.version:
+            form.not_modified = True
+            form.message = 'Not modified'
+            return form
+        if not delta:
+            return self.to_form(message)
+        form.message = message
+        form.changed_cards = self.changed_cards(known_version)
+        if self.game_over:
+            form.seed = self.seed
+        return form
+
+    def to_summary_form(self, user_name):
+        """Returns a GameForm without the card layout. Works on Games loaded
+        by a projection query on summary_properties."""
+        return GameForm(urlsafe_key=self.key.urlsafe(), user_name=user_name,
+                        attempts_remaining=self.attempts_remaining,
+                        game_over=False,
+                        message='You have guessed %s pairs' % self.guessed_pairs)
+
+    @classmethod
+    def play(cls, game_key, guesses, respond, response_type,
+             expected_version=None, request_id=None, cache=None):
+        """Makes (guess1, guess2) guesses on the Game with key game_key in one
+        transaction. Returns the response_type message that respond(game,
+        outcomes) builds, or None if there is no such game."""
+        if cache:
+            cache.delete(game_key)
+
+        def txn():
+            if request_id:
+                receipt = GuessReceipt.key_for(game_key, request_id).get()
+                if receipt:
+                    return receipt.decode(response_type), None
+            game = game_key.get()
+            if not game:
+                return None, None
+            if expected_version is not None and game.version != expected_version:
+                raise VersionConflict(game.version)
+            outcomes = game.apply_guesses(guesses)
+            batch = WriteBatch()
+            if not game.game_over and game.is_finished():
+                won = game.guessed_pairs == game.num_cards() // 2
+                game.end_game(won, batch)
+                GameStats.record_ended(game, won)
+            else:
+                if any(outcome[3] for outcome in outcomes):
+                    game._put_to(batch)
+                GameStats.record({GameStats.ATTEMPTS_REMAINING:
+                                  -getattr(game, '_attempts_used', 0)})
+            response = respond(game, outcomes)
+            if request_id:
+                batch.put(GuessReceipt.build(game_key, request_id, response))
+            batch.flush()
+            return response, game
+
+        for attempt in range(guess_retries + 1):
+            try:
+                response, game = ndb.transaction(txn, xg=True, retries=0)
+                break
+            except datastore_errors.TransactionFailedError:
+                if attempt == guess_retries:
+                    raise
+                time.sleep(guess_backoff * 2 ** attempt *
+                           random.uniform(0.5, 1.5))
+
+        if game and cache:
+            cache.put(game)
+        return response
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def cancel(cls, game_key):
+        """Deletes the Game with key game_key, with its HistoryChunks and
+        GuessReceipts, in one transaction if it is not over. Returns the
+        Game, which is left as it is if game_over is set, or None if there
+        is no such game."""
+        game = game_key.get()
+        if not game or game.game_over:
+            return game
+        receipt_keys = GuessReceipt.query(ancestor=game_key).fetch(
+            keys_only=True)
+        ndb.delete_multi([game_key] + game.history_chunk_keys() +
+                         receipt_keys)
+        return game
 
-        if number1 == -1 or number2 == -1:
-            return self.to_form('These cards are already correctly guessed')
+    def apply_guesses(self, guesses):
+        """Applies a sequence of (guess1, guess2) guesses in order without
+        saving the game, stopping when the game is over. Returns a list of
+        (guess1, guess2, message, result) tuples for the guesses made, where
+        result is None for a guess that was rejected."""
+        outcomes = []
+        for guess1, guess2 in guesses:
+            if self.game_over or self.is_finished():
+                break
+            outcomes.append((guess1, guess2) + self.apply_guess(guess1, guess2))
+        return outcomes
+
+    def is_finished(self):
+        """Returns True once all pairs are guessed or no attempts remain"""
+        return self.guessed_pairs == self.num_cards() // 2 or \
+            self.attempts_remaining == 0
+
+    def apply_guess(self, guess1, guess2):
+        """Applies a guess to the game without saving it. Returns a tuple of
+        the message for the player and the result recorded in the history,
+        which is None if the guess was rejected and did not change the game."""
+        last_card = self.num_cards() - 1
+        if (guess1 < 0 or guess1 > last_card) or\
+                (guess2 < 0 or guess2 > last_card):
+            return 'Card numbers needs to be between 0 and %s' % last_card, None
+        if guess1 == guess2:
+            return 'Two guesses need to be for different cards', None
+        if self.is_matched(guess1) or self.is_matched(guess2):
+            return 'These cards are already correctly guessed', None
+        number1 = self.card_value(guess1)
+        number2 = self.card_value(guess2)
         
         self.attempts_remaining -= 1
+        self.version += 1
+        # Not yet subtracted from GameStats, see play
+        self._attempts_used = getattr(self, '_attempts_used', 0) + 1
 
         if number1 != number2:
             msg = 'Wrong guess. Number for card {0} is {1} and for card {2} is {3}'.format(guess1,
                 number1, guess2, number2)
             result = "Wrong"
         else:
-            # Mark correctly guessed pair with -1
             self.guessed_pairs += 1
-            self.pairs[guess1] = -1
-            self.pairs[guess2] = -1
+            self._mark_matched(guess1)
+            self._mark_matched(guess2)
+            self._set_match_version((guess1, guess2))
 
-            msg = 'Correct guess! You have %s pairs remaining.' % (std_num_pairs - self.guessed_pairs)
+            msg = 'Correct guess! You have %s pairs remaining.' % (self.num_cards() // 2 - self.guessed_pairs)
             result = "Correct"
 
-        if self.guessed_pairs == std_num_pairs:
-            self.end_game(True)
+        if self.guessed_pairs == self.num_cards() // 2:
             msg = 'You correctly guessed all pairs in %s' % (self.attempts_allowed - self.attempts_remaining)
             result += ", Win"
         elif self.attempts_remaining == 0:
-            self.end_game(False)
             msg = 'You ran out of guesses. Game over!'
             result += ", Loss"
 
-        self.history.append('(Guess: [{0}, {1}], Result: {2})'.format(guess1, guess2, result))
-        self.put()
-        return self.to_form(msg)
+        self._append_history(guess1, guess2, result)
+        return msg, result
+
+    def _migrate_history(self):
+        """Converts the legacy history strings to packed entries"""
+        if self.history:
+            entries = ''.join(history_entry.pack(*entry)
+                              for entry in parse_legacy_history(self.history))
+            self.history_tail = entries + (self.history_tail or '')
+            self.history_count = len(self.history)
+            self.history = []
+
+    def _append_history(self, guess1, guess2, result):
+        """Appends a guess to the history. Full chunks are moved out of
+        history_tail into HistoryChunk entities, which are written the next
+        time the game is saved."""
+        self._migrate_history()
+        self.history_tail = (self.history_tail or '') + history_entry.pack(
+            guess1, guess2, RESULT_CODES[result], int(time.time()))
+        self.history_count += 1
+        chunk_bytes = history_chunk_size * history_entry.size
+        while len(self.history_tail) >= chunk_bytes:
+            sealed = self.history_count - len(self.history_tail) // history_entry.size
+            chunk = HistoryChunk(key=HistoryChunk.key_for(
+                self.key, sealed // history_chunk_size),
+                entries=self.history_tail[:chunk_bytes])
+            self._pending_chunks = getattr(self, '_pending_chunks', []) + [chunk]
+            self.history_tail = self.history_tail[chunk_bytes:]
+
+    def history_page(self, offset=0, limit=20):
+        """Returns up to limit history entries as (guess1, guess2, result,
+        timestamp) tuples starting at entry number offset, and the offset of
+        the next page, or None if this is the last page"""
+        if self.history:
+            entries = parse_legacy_history(self.history)[offset:offset + limit]
+            count = len(self.history)
+        else:
+            entries = self._read_history(offset,
+                                         min(offset + limit, self.history_count))
+            count = self.history_count
+        next_offset = offset + len(entries)
+        return entries, next_offset if next_offset < count else None
+
+    def _read_history(self, start, end):
+        """Returns history entries start to end, fetching only the
+        HistoryChunks that hold them"""
+        if start >= end:
+            return []
+        tail = unpack_history(self.history_tail)
+        sealed = self.history_count - len(tail)
+        entries = []
+        if start < sealed:
+            first = start // history_chunk_size
+            last = (min(end, sealed) - 1) // history_chunk_size
+            chunks = ndb.get_multi([HistoryChunk.key_for(self.key, index)
+                                    for index in range(first, last + 1)])
+            for chunk in chunks:
+                entries += unpack_history(chunk.entries)
+            entries = entries[start - first * history_chunk_size:]
+        if end > sealed:
+            entries += tail[max(start - sealed, 0):]
+        return entries[:end - start]
 
-    def end_game(self, won=False):
+    def history_chunk_keys(self):
+        """Returns the keys of all the game's HistoryChunks"""
+        self._migrate_history()
+        sealed = self.history_count - \
+            len(self.history_tail or '') // history_entry.size
+        return [HistoryChunk.key_for(self.key, index)
+                for index in range(sealed // history_chunk_size)]
+
+    def to_archive(self, chunks):
+        """Returns an ArchivedGame of the game, given its HistoryChunks in
+        order"""
+        self._migrate_card_state()
+        self._migrate_history()
+        return ArchivedGame(
+            key=ArchivedGame.key_for(self.key),
+            user=self.user,
+            user_name=self.user_name,
+            seed=self.seed,
+            cards=self.cards,
+            matched=self.matched,
+            guessed_pairs=self.guessed_pairs,
+            attempts_allowed=self.attempts_allowed,
+            attempts_remaining=self.attempts_remaining,
+            history=''.join(chunk.entries for chunk in chunks if chunk) +
+                    (self.history_tail or ''),
+            history_count=self.history_count,
+            last_modified=self.last_modified)
+
+    def _put_to(self, batch):
+        """Adds the game and its newly filled HistoryChunks to batch"""
+        batch.put(self)
+        for chunk in getattr(self, '_pending_chunks', []):
+            batch.put(chunk)
+
+    def end_game(self, won, batch):
         """Ends the game - if won is True, the player won. - if won is False,
-        the player lost."""
+        the player lost. Must be called in a transaction. The Game and its
+        Score are added to batch for the caller to flush, and a task that
+        adds the Score to the shared rollups is enqueued with the
+        transaction, see Score.rank. The GuessReceipts of earlier requests
+        are deleted, since a finished game cannot change any more."""
         self.game_over = True
-        self.put()
-        # Add the game to the score 'board'
-        score = Score(user=self.user, date=date.today(), won=won,
+        self._put_to(batch)
+        # The receipt of the request that ends the game is not stored yet,
+        # so it is kept for retries
+        ndb.delete_multi(GuessReceipt.query(ancestor=self.key).fetch(
+            keys_only=True))
+        # Add the game to the score 'board'. The key is allocated up front
+        # so that the task can be enqueued before the batch is flushed.
+        score_id, _ = Score.allocate_ids(1)
+        score = Score(key=ndb.Key(Score, score_id),
+                      user=self.user, user_name=self.user_name,
+                      date=date.today(), won=won,
                       guesses=self.attempts_allowed - self.attempts_remaining,
                       score=float(self.attempts_remaining) / self.attempts_allowed)
-        score.put()
+        batch.put(score)
+        taskqueue.add(url='/tasks/rank_score',
+                      params={'score': score.key.urlsafe()},
+                      transactional=True)
 
-        AverageScore.add_score(self.user, score.score)
+
+# Properties read by projection queries listing unfinished games
+Game.summary_properties = [Game.attempts_remaining, Game.guessed_pairs]
+
+
+class HistoryChunk(ndb.Model):
+    """A full chunk of history_chunk_size guesses of a Game, packed with
+    history_entry. Child of the Game, keyed by chunk number + 1."""
+    entries = ndb.BlobProperty(required=True)
+
+    @classmethod
+    def key_for(cls, game_key, index):
+        return ndb.Key(cls, index + 1, parent=game_key)
+
+
+class GuessReceipt(ndb.Model):
+    """Response to guesses made with a request id. Child of the Game, keyed
+    by the request id, so that it is written in the same transaction as the
+    guesses and a retried request gets the stored response. Only the
+    receipt of the last request is kept once the game is over."""
+    # The response message, encoded with protojson
+    response = ndb.TextProperty(required=True)
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+    @classmethod
+    def key_for(cls, game_key, request_id):
+        return ndb.Key(cls, request_id, parent=game_key)
+
+    @classmethod
+    def build(cls, game_key, request_id, response):
+        return cls(key=cls.key_for(game_key, request_id),
+                   response=protojson.encode_message(response))
+
+    def decode(self, response_type):
+        """Returns the stored response as a response_type message"""
+        return protojson.decode_message(response_type, self.response)
+
+
+class ArchivedGame(ndb.Model):
+    """Compact copy of an unfinished Game that was abandoned and removed by
+    the reaper. Keyed by the id of the Game. The whole history, packed with
+    history_entry, is kept in one compressed blob."""
+    user = ndb.KeyProperty(kind='User')
+    user_name = ndb.StringProperty(indexed=False)
+    seed = ndb.IntegerProperty(indexed=False)
+    # Always stored: the shuffle a seed produces differs between Python
+    # versions, so the deck cannot be relied on to be regenerated from it
+    cards = ndb.BlobProperty()
+    matched = ndb.BlobProperty()
+    guessed_pairs = ndb.IntegerProperty(indexed=False)
+    attempts_allowed = ndb.IntegerProperty(indexed=False)
+    attempts_remaining = ndb.IntegerProperty(indexed=False)
+    history = ndb.BlobProperty(compressed=True)
+    history_count = ndb.IntegerProperty(indexed=False)
+    last_modified = ndb.DateTimeProperty(indexed=False)
+    archived = ndb.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def key_for(cls, game_key):
+        return ndb.Key(cls, game_key.id())
+
+
+# Result codes stored in history entries, matching GuessResult
+RESULT_CODES = {
+    'Wrong': 1,
+    'Correct': 2,
+    'Wrong, Loss': 3,
+    'Correct, Win': 4,
+    'Correct, Loss': 5,
+}
+RESULT_NAMES = dict((code, name) for name, code in RESULT_CODES.items())
+
+_legacy_history_pattern = re.compile(
+    r'\(Guess: \[(\d+), (\d+)\], Result: ([\w, ]+)\)')
+
+
+def unpack_history(packed):
+    """Returns a list of (guess1, guess2, result code, timestamp) tuples"""
+    if not packed:
+        return []
+    return [history_entry.unpack_from(packed, offset)
+            for offset in range(0, len(packed), history_entry.size)]
+
+
+def parse_legacy_history(history):
+    """Converts legacy history strings to history entries. Their time is not
+    known, so the timestamp is 0."""
+    entries = []
+    for line in history:
+        match = _legacy_history_pattern.match(line)
+        if match:
+            entries.append((int(match.group(1)), int(match.group(2)),
+                            RESULT_CODES.get(match.group(3), 0), 0))
+    return entries
 
 
 class Score(ndb.Model):
     """Score object"""
     user = ndb.KeyProperty(required=True, kind='User')
+    # Denormalized from User so that listing scores needs no user lookups
+    user_name = ndb.StringProperty(indexed=False)
     date = ndb.DateProperty(required=True)
     won = ndb.BooleanProperty(required=True)
     guesses = ndb.IntegerProperty(required=True)
     score = ndb.FloatProperty(required=True)
+    # Set once the score has been added to the rollups by rank
+    ranked = ndb.BooleanProperty(default=False, indexed=False)
 
-    def to_form(self):
-        return ScoreForm(user_name=self.user.get().name if self.user else None, won=self.won,
+    @classmethod
+    @ndb.transactional(xg=True)
+    def rank(cls, score_key):
+        """Adds a Score to the rollups, rank indexes and leaderboards in one
+        transaction, once. Run by the /tasks/rank_score task."""
+        score = score_key.get()
+        if not score or score.ranked:
+            return
+        batch = WriteBatch()
+        AverageScore.add_score(score.user, score.score, batch)
+        for window in leaderboard_windows:
+            WindowScore.add_score(score, window, batch)
+            if score.won:
+                Leaderboard.add_score(
+                    score, batch, Leaderboard.name_for(window, score.date))
+        score.ranked = True
+        batch.put(score)
+        batch.flush()
+
+    def to_form(self, user_name=None):
+        if not user_name and self.user:
+            user_name = self.user_name or self.user.get().name
+        return ScoreForm(user_name=user_name, won=self.won,
                          date=str(self.date), guesses=self.guesses,
                          score=self.score)
 
+    @classmethod
+    def to_forms(cls, scores, next_cursor=None):
+        """Returns a ScoreForms representation of a list of Scores, resolving
+        all user names in one batch"""
+        scores = list(scores)
+        names = get_user_names(scores)
+        return ScoreForms(items=[score.to_form(names.get(score.user))
+                                 for score in scores],
+                          next_cursor=next_cursor)
+
 class AverageScore(ndb.Model):
     """Average score of a user"""
     user = ndb.KeyProperty(required=True, kind='User')
     num_score = ndb.IntegerProperty(required=True)
     avg_score = ndb.FloatProperty(required=True)
+    # Rank index bucket the average score currently falls into
+    bucket = ndb.IntegerProperty()
+
+    @classmethod
+    def key_for(cls, user):
+        """Returns the key of the AverageScore of the user with key user"""
+        return ndb.Key(cls, user.id())
 
     @classmethod
-    def add_score(cls, user, score):
-        """Updates average score of a user. Create a new row if nothing exists."""
-        avg_score = AverageScore.query(AverageScore.user == user).get()
+    def add_score(cls, user, score, batch):
+        """Updates average score of a user. Create a new row if nothing exists.
+        The average score and the rank index are updated as part of batch.
+        Must be called in a transaction."""
+        avg_score = cls.key_for(user).get()
         if not avg_score:
-            return AverageScore(user=user, num_score=1, avg_score=score).put()
+            avg_score = AverageScore(key=cls.key_for(user), user=user,
+                                     num_score=0, avg_score=0.0)
+        old_bucket = avg_score.bucket
         avg_score.num_score += 1
         avg_score.avg_score = (avg_score.avg_score * (avg_score.num_score - 1) + score) / avg_score.num_score
-        avg_score.put()
+        avg_score.bucket = RankBucket.bucket_for(avg_score.avg_score)
+        to_put = [avg_score]
+        if old_bucket != avg_score.bucket:
+            to_put += RankBucket.move(old_bucket, avg_score.bucket)
+        for entity in to_put:
+            batch.put(entity)
+
+    @classmethod
+    @ndb.tasklet
+    def get_with_rank_async(cls, user):
+        """Returns a future for a tuple of the AverageScore of the user with
+        key user and its rank among all users, or (None, None) if the user
+        has no average score yet. Users in higher buckets are counted from
+        the rank index and only the users sharing the user's bucket are
+        counted with a query. The whole rank index is fetched in parallel
+        with the AverageScore, so only the count waits on the score."""
+        avg_score, buckets = yield (
+            cls.key_for(user).get_async(),
+            ndb.get_multi_async([RankBucket.key_for(b)
+                                 for b in range(num_rank_buckets)]))
+        if not avg_score:
+            raise ndb.Return((None, None))
+        bucket = RankBucket.bucket_for(avg_score.avg_score)
+        same_bucket = yield cls.query(
+            cls.bucket == bucket,
+            cls.avg_score > avg_score.avg_score).count_async()
+        higher = sum(b.count for b in buckets[bucket + 1:] if b)
+        raise ndb.Return((avg_score, higher + same_bucket + 1))
+
+
+# Average scores lie between 0 and 1 and are split into this many equal ranges
+# for the rank index.
+num_rank_buckets = 100
+
+
+class RankBucket(ndb.Model):
+    """Rank index entry holding the number of users whose average score falls
+    into one bucket. Keyed by bucket number. The rank indexes of leaderboard
+    windows, which count users by their best score in the window, are keyed
+    by '<window id>:<bucket number>'."""
+    count = ndb.IntegerProperty(required=True, default=0, indexed=False)
+
+    @staticmethod
+    def bucket_for(avg_score):
+        return max(0, min(int(avg_score * num_rank_buckets), num_rank_buckets - 1))
+
+    @classmethod
+    def key_for(cls, bucket, window_id=None):
+        """Returns the key of a bucket of the average score rank index, or
+        of the rank index of the window with window_id"""
+        if window_id:
+            return ndb.Key(cls, '%s:%d' % (window_id, bucket))
+        return ndb.Key(cls, str(bucket))
+
+    @classmethod
+    def move(cls, old_bucket, new_bucket, window_id=None):
+        """Moves one user from old_bucket to new_bucket. Either may be None
+        when a user enters or leaves the index. Returns the changed buckets,
+        which the caller puts in the same transaction as the AverageScore or
+        WindowScore."""
+        keys = [cls.key_for(b, window_id)
+                for b in (old_bucket, new_bucket) if b is not None]
+        buckets = [bucket or cls(key=key)
+                   for key, bucket in zip(keys, ndb.get_multi(keys))]
+        if old_bucket is not None:
+            buckets[0].count -= 1
+        if new_bucket is not None:
+            buckets[-1].count += 1
+        return buckets
+
+    @classmethod
+    def rebuild(cls):
+        """Recomputes the whole rank index from AverageScore. Only needed to
+        backfill existing data or to repair the index."""
+        counts = [0] * num_rank_buckets
+        to_put = []
+        for avg_score in AverageScore.query():
+            bucket = cls.bucket_for(avg_score.avg_score)
+            counts[bucket] += 1
+            if avg_score.bucket != bucket:
+                avg_score.bucket = bucket
+                to_put.append(avg_score)
+        ndb.put_multi(to_put)
+        ndb.put_multi([cls(key=cls.key_for(b), count=count)
+                       for b, count in enumerate(counts)])
+
+
+# Leaderboard windows. Daily and weekly windows start over every day and
+# every ISO week.
+DAILY = 'daily'
+WEEKLY = 'weekly'
+ALL_TIME = 'all'
+leaderboard_windows = (DAILY, WEEKLY, ALL_TIME)
+
+
+def window_id(window, day):
+    """Returns the id of the window of type window that day falls into,
+    such as 'daily:2016-05-02' or 'weekly:2016-W18'"""
+    if window == DAILY:
+        return '%s:%s' % (DAILY, day.isoformat())
+    if window == WEEKLY:
+        year, week, _ = day.isocalendar()
+        return '%s:%d-W%02d' % (WEEKLY, year, week)
+    if window == ALL_TIME:
+        return ALL_TIME
+    raise ValueError('Unknown leaderboard window %s' % window)
+
+
+class WindowScore(ndb.Model):
+    """Rollup of the games a user finished in one leaderboard window. Keyed
+    by '<window id>:<user id>'. Users are ranked in a window by their best
+    score, with a rank index of RankBuckets per window."""
+    window = ndb.StringProperty(required=True)
+    user = ndb.KeyProperty(required=True, kind='User', indexed=False)
+    user_name = ndb.StringProperty(indexed=False)
+    games = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    wins = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    best_score = ndb.FloatProperty(required=True)
+    bucket = ndb.IntegerProperty(required=True)
+
+    @classmethod
+    def key_for(cls, window_id, user):
+        """Returns the key of the WindowScore of the user with key user"""
+        return ndb.Key(cls, '%s:%s' % (window_id, user.id()))
+
+    @classmethod
+    def add_score(cls, score, window, batch):
+        """Adds a Score to the user's rollup of the window of type window
+        the score's date falls into, as part of batch. Must be called in a
+        transaction."""
+        wid = window_id(window, score.date)
+        key = cls.key_for(wid, score.user)
+        window_score = key.get()
+        if not window_score:
+            window_score = cls(key=key, window=wid, user=score.user,
+                               best_score=score.score,
+                               bucket=RankBucket.bucket_for(score.score))
+            old_bucket = None
+        else:
+            old_bucket = window_score.bucket
+        window_score.user_name = score.user_name
+        window_score.games += 1
+        window_score.wins += 1 if score.won else 0
+        window_score.best_score = max(window_score.best_score, score.score)
+        window_score.bucket = RankBucket.bucket_for(window_score.best_score)
+        batch.put(window_score)
+        if old_bucket != window_score.bucket:
+            for bucket in RankBucket.move(old_bucket, window_score.bucket,
+                                          wid):
+                batch.put(bucket)
+
+    @classmethod
+    @ndb.tasklet
+    def get_with_rank_async(cls, user, window_id):
+        """Returns a future for a tuple of the WindowScore of the user with
+        key user in the window with window_id and its rank by best score
+        among the users who finished a game in the window, or (None, None)
+        if the user has not. Ranked like AverageScore.get_with_rank_async."""
+        window_score, buckets = yield (
+            cls.key_for(window_id, user).get_async(),
+            ndb.get_multi_async([RankBucket.key_for(b, window_id)
+                                 for b in range(num_rank_buckets)]))
+        if not window_score:
+            raise ndb.Return((None, None))
+        same_bucket = yield cls.query(
+            cls.window == window_id,
+            cls.bucket == window_score.bucket,
+            cls.best_score > window_score.best_score).count_async()
+        higher = sum(b.count for b in buckets[window_score.bucket + 1:] if b)
+        raise ndb.Return((window_score, higher + same_bucket + 1))
+
+
+# Number of scores kept on a Leaderboard
+leaderboard_size = 100
+
+
+class LeaderboardEntry(ndb.Model):
+    """One score on a Leaderboard"""
+    user = ndb.KeyProperty(kind='User')
+    user_name = ndb.StringProperty()
+    date = ndb.DateProperty()
+    guesses = ndb.IntegerProperty()
+    score = ndb.FloatProperty()
+    # Key of the Score, so that a score is never added to a board twice
+    score_key = ndb.KeyProperty(kind='Score')
+
+    @classmethod
+    def from_score(cls, score):
+        return cls(user=score.user, user_name=score.user_name,
+                   date=score.date, guesses=score.guesses, score=score.score,
+                   score_key=score.key)
+
+    def to_form(self):
+        return ScoreForm(user_name=self.user_name, won=True,
+                         date=str(self.date), guesses=self.guesses,
+                         score=self.score)
+
+
+class Leaderboard(ndb.Model):
+    """The leaderboard_size best scores of won games, best first. Updated as
+    games end and cached in memcache, so reading it never queries Scores.
+    The all-time board is keyed HIGH_SCORES and the board of each daily and
+    weekly window by its window id."""
+    entries = ndb.LocalStructuredProperty(LeaderboardEntry, repeated=True)
+
+    HIGH_SCORES = 'high_scores'
+    MEMCACHE_PREFIX = 'leaderboard:'
+
+    @classmethod
+    def key_for(cls, name):
+        return ndb.Key(cls, name)
+
+    @classmethod
+    def name_for(cls, window, day):
+        """Returns the name of the board of the window of type window that
+        day falls into"""
+        if window == ALL_TIME:
+            return cls.HIGH_SCORES
+        return window_id(window, day)
+
+    @classmethod
+    def get_board(cls, name=HIGH_SCORES):
+        """Returns the named Leaderboard from memcache or the datastore.
+        Builds the high score board from the Scores the first time it is
+        read. A window's board that does not exist yet is empty."""
+        board = memcache.get(cls.MEMCACHE_PREFIX + name)
+        if board is None:
+            board = cls.key_for(name).get()
+            if not board:
+                board = cls.rebuild() if name == cls.HIGH_SCORES \
+                    else cls(key=cls.key_for(name))
+            board._cache()
+        return board
+
+    def _cache(self):
+        memcache.set(self.MEMCACHE_PREFIX + self.key.id(), self)
+
+    def qualifies(self, score):
+        return len(self.entries) < leaderboard_size or \
+            score.score > self.entries[-1].score
+
+    @classmethod
+    def add_score(cls, score, batch, name=HIGH_SCORES):
+        """Adds a won game's Score to the named board, if it makes it, as
+        part of batch. Must be called in a transaction, which is why the
+        high score board is never rebuilt here. Most scores are ruled out
+        against the cached board without a datastore read. A score already
+        on the board, e.g. one a rebuild picked up before it was ranked, is
+        not added again."""
+        cached = memcache.get(cls.MEMCACHE_PREFIX + name)
+        if cached and not cached.qualifies(score):
+            return
+        board = cls.key_for(name).get()
+        if not board:
+            # The high score board is built from the Scores, this one
+            # included, the first time it is read. A window's board starts
+            # empty.
+            if name == cls.HIGH_SCORES:
+                return
+            board = cls(key=cls.key_for(name))
+        if not board.qualifies(score) or \
+                any(entry.score_key == score.key for entry in board.entries):
+            return
+        board.entries.append(LeaderboardEntry.from_score(score))
+        board.entries.sort(key=lambda entry: entry.score, reverse=True)
+        del board.entries[leaderboard_size:]
+        batch.put(board)
+        ndb.get_context().call_on_commit(board._cache)
+
+    @classmethod
+    def rebuild(cls):
+        """Builds the high score board from all Scores and saves it. Only
+        needed the first time and to repair the board. Scores whose rank
+        task has not run yet are included, and skipped by add_score when
+        it does."""
+        scores = Score.query(Score.won == True).order(-Score.score)\
+            .fetch(leaderboard_size)
+        board = cls(key=cls.key_for(cls.HIGH_SCORES),
+                    entries=[LeaderboardEntry.from_score(score)
+                             for score in scores])
+        board.put()
+        return board
+
+
+class CounterShard(ndb.Model):
+    """One of the counter_shards shards of a named counter, keyed by
+    '<name>:<shard>'. Each increment goes to a random shard so that
+    concurrent increments rarely contend for the same entity group, and the
+    counter's value is the sum of its shards."""
+    # Shards are summed on every read and change too often to be worth
+    # caching.
+    _use_memcache = False
+
+    count = ndb.IntegerProperty(required=True, default=0, indexed=False)
+
+    @classmethod
+    def key_for(cls, name, shard):
+        return ndb.Key(cls, '%s:%d' % (name, shard))
+
+    @classmethod
+    def incr_multi(cls, deltas):
+        """Adds each delta in a dict of counter name to delta to its counter.
+        The counters are updated in parallel, each in its own transaction."""
+        futures = [cls._incr_async(cls.key_for(name,
+                                               random.randrange(counter_shards)),
+                                   delta)
+                   for name, delta in deltas.items() if delta]
+        ndb.Future.wait_all(futures)
+        for future in futures:
+            future.check_success()
+
+    @classmethod
+    @ndb.transactional_tasklet(
+        propagation=ndb.TransactionOptions.INDEPENDENT)
+    def _incr_async(cls, key, delta):
+        shard = yield key.get_async()
+        shard = shard or cls(key=key)
+        shard.count += delta
+        yield shard.put_async()
+
+    @classmethod
+    def get_multi(cls, names):
+        """Returns a dict of counter name to value, reading all shards of all
+        the counters in one batch"""
+        keys = [cls.key_for(name, shard)
+                for name in names for shard in range(counter_shards)]
+        shards = ndb.get_multi(keys)
+        totals = dict.fromkeys(names, 0)
+        for key, shard in zip(keys, shards):
+            if shard:
+                totals[key.id().rsplit(':', 1)[0]] += shard.count
+        return totals
+
+    @classmethod
+    def reset(cls, totals):
+        """Sets counters to the values in a dict of counter name to value.
+        Only meant for repairs, since increments made meanwhile are lost."""
+        shards = []
+        for name, total in totals.items():
+            shards += [cls(key=cls.key_for(name, shard),
+                           count=total if shard == 0 else 0)
+                       for shard in range(counter_shards)]
+        ndb.put_multi(shards)
+
+
+class GameStats(object):
+    """Global game statistics kept in sharded counters. They are updated
+    as games are created, played, ended and cancelled, so reading them never
+    touches the Games themselves."""
+    ACTIVE_GAMES = 'active_games'
+    ATTEMPTS_REMAINING = 'attempts_remaining'
+    WINS = 'wins'
+    LOSSES = 'losses'
+
+    @staticmethod
+    def games_created(day):
+        """Name of the counter of games created on day"""
+        return 'games_created:%s' % day.isoformat()
+
+    @classmethod
+    def record(cls, deltas):
+        """Enqueues a /tasks/record_game_stats task that adds deltas to the
+        counters, so the request does not wait on the shard transactions.
+        In a transaction the task is enqueued with it and only runs if it
+        commits. Otherwise the change was already saved, so a failure is
+        logged rather than failing the request."""
+        deltas = dict((name, delta) for name, delta in deltas.items()
+                      if delta)
+        if not deltas:
+            return
+        params = {'deltas': json.dumps(deltas)}
+        if ndb.in_transaction():
+            taskqueue.add(url='/tasks/record_game_stats', params=params,
+                          transactional=True)
+            return
+        try:
+            taskqueue.add(url='/tasks/record_game_stats', params=params)
+        except Exception:
+            logging.exception('Could not record game stats %s', deltas)
+
+    @classmethod
+    def apply(cls, deltas):
+        """Adds deltas recorded by record to the counters. A task that is
+        retried after some shards were updated counts those twice, which
+        rebuild repairs."""
+        CounterShard.incr_multi(deltas)
+
+    @classmethod
+    def record_created(cls, games):
+        cls.record({
+            cls.ACTIVE_GAMES: len(games),
+            cls.ATTEMPTS_REMAINING: sum(game.attempts_remaining
+                                        for game in games),
+            cls.games_created(date.today()): len(games),
+        })
+
+    @classmethod
+    def record_ended(cls, game, won):
+        """Counts a game that was won or lost. Its remaining attempts are
+        subtracted along with the ones its last guesses used."""
+        cls.record({
+            cls.ACTIVE_GAMES: -1,
+            cls.ATTEMPTS_REMAINING: -(game.attempts_remaining +
+                                      getattr(game, '_attempts_used', 0)),
+            cls.WINS if won else cls.LOSSES: 1,
+        })
+
+    @classmethod
+    def record_removed(cls, games):
+        """Counts unfinished games that were cancelled or archived"""
+        cls.record({
+            cls.ACTIVE_GAMES: -len(games),
+            cls.ATTEMPTS_REMAINING: -sum(game.attempts_remaining
+                                         for game in games),
+        })
+
+    @classmethod
+    def get(cls, days=1):
+        """Returns a dict of the counters, with 'games_per_day' holding
+        (date, games created) tuples for the last days days, today first"""
+        today = date.today()
+        dates = [today - timedelta(days=n) for n in range(days)]
+        names = [cls.ACTIVE_GAMES, cls.ATTEMPTS_REMAINING, cls.WINS, cls.LOSSES]
+        totals = CounterShard.get_multi(
+            names + [cls.games_created(day) for day in dates])
+        stats = dict((name, totals[name]) for name in names)
+        stats['games_per_day'] = [(day, totals[cls.games_created(day)])
+                                  for day in dates]
+        return stats
+
+    @classmethod
+    def rebuild(cls):
+        """Recounts the active games, attempts remaining, wins and losses
+        from the Games and Scores. Only needed to backfill existing data or
+        to repair the counters. Games per day cannot be recounted."""
+        active_games = attempts_remaining = 0
+        for game in Game.query(Game.game_over == False):
+            active_games += 1
+            attempts_remaining += game.attempts_remaining
+        CounterShard.reset({
+            cls.ACTIVE_GAMES: active_games,
+            cls.ATTEMPTS_REMAINING: attempts_remaining,
+            cls.WINS: Score.query(Score.won == True).count(),
+            cls.LOSSES: Score.query(Score.won == False).count(),
+        })
+
 
 class GameForm(messages.Message):
     """GameForm for outbound game state information"""
@@ -144,15 +1169,47 @@ class GameForm(messages.Message):
     game_over = messages.BooleanField(3, required=True)
     message = messages.StringField(4, required=True)
     user_name = messages.StringField(5, required=True)
-    card_layout = messages.StringField(6, required=True)
+    # Not set when listing games
+    card_layout = messages.StringField(6)
+    # Seed of the deck, set when the game is over
+    seed = messages.IntegerField(7)
+    version = messages.IntegerField(8)
+    # Set instead of card_layout when the client asked for a delta
+    changed_cards = messages.IntegerField(9, repeated=True)
+    # True when the client already has the current version
+    not_modified = messages.BooleanField(10)
 
 class GameForms(messages.Message):
-    """Return multiple GameForm"""
+    """Return multiple GameForm, or only their keys"""
     items = messages.MessageField(GameForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+    urlsafe_keys = messages.StringField(3, repeated=True)
+
+class GuessResult(messages.Enum):
+    """Result of a guess, as recorded in the game history"""
+    WRONG = 1
+    CORRECT = 2
+    WRONG_LOSS = 3
+    CORRECT_WIN = 4
+    CORRECT_LOSS = 5
+
+
+class HistoryEntryForm(messages.Message):
+    """One guess of a game history"""
+    guess1 = messages.IntegerField(1, required=True)
+    guess2 = messages.IntegerField(2, required=True)
+    result = messages.EnumField(GuessResult, 3)
+    # Seconds since the epoch, 0 for guesses made before times were recorded
+    timestamp = messages.IntegerField(4, required=True)
+
 
 class GameHistoryForm(messages.Message):
+    """Return a page of a game's history"""
     urlsafe_key = messages.StringField(1, required=True)
+    # The same guesses as entries, formatted as text
     history = messages.StringField(2, repeated=True)
+    entries = messages.MessageField(HistoryEntryForm, 3, repeated=True)
+    next_cursor = messages.StringField(4)
 
 
 class NewGameForm(messages.Message):
@@ -161,10 +1218,59 @@ class NewGameForm(messages.Message):
     attempts = messages.IntegerField(2, required=True)
 
 
+class NewGamesForm(messages.Message):
+    """Used to create many new games at once"""
+    items = messages.MessageField(NewGameForm, 1, repeated=True)
+
+
+class NewGameResultForm(messages.Message):
+    """Outcome of creating one game of a NewGamesForm"""
+    user_name = messages.StringField(1, required=True)
+    urlsafe_key = messages.StringField(2)
+    error = messages.StringField(3)
+
+
+class NewGameResultForms(messages.Message):
+    """Return the outcome of each game of a NewGamesForm, in order"""
+    items = messages.MessageField(NewGameResultForm, 1, repeated=True)
+
+
 class MakeGuessForm(messages.Message):
     """Used to make a guess in an existing game"""
     guess1 = messages.IntegerField(1, required=True)
     guess2 = messages.IntegerField(2, required=True)
+    # Version of the game the guess was made on, checked when given
+    expected_version = messages.IntegerField(3)
+    # Idempotency key, so that a retried request is only applied once
+    request_id = messages.StringField(4)
+
+
+class GuessForm(messages.Message):
+    """One guess of a MakeGuessesForm"""
+    guess1 = messages.IntegerField(1, required=True)
+    guess2 = messages.IntegerField(2, required=True)
+
+
+class MakeGuessesForm(messages.Message):
+    """Used to make a sequence of guesses in an existing game"""
+    guesses = messages.MessageField(GuessForm, 1, repeated=True)
+    expected_version = messages.IntegerField(2)
+    request_id = messages.StringField(3)
+
+
+class GuessResultForm(messages.Message):
+    """Outcome of one guess of a MakeGuessesForm"""
+    guess1 = messages.IntegerField(1, required=True)
+    guess2 = messages.IntegerField(2, required=True)
+    message = messages.StringField(3, required=True)
+    # As recorded in the game history, not set if the guess was rejected
+    result = messages.StringField(4)
+
+
+class GuessResultForms(messages.Message):
+    """Return the outcome of each guess made and the final game state"""
+    items = messages.MessageField(GuessResultForm, 1, repeated=True)
+    game = messages.MessageField(GameForm, 2, required=True)
 
 
 class ScoreForm(messages.Message):
@@ -179,6 +1285,7 @@ class ScoreForm(messages.Message):
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class UserRankingForm(messages.Message):
@@ -187,6 +1294,95 @@ class UserRankingForm(messages.Message):
     rank=messages.IntegerField(2, required=True)
     score=messages.FloatField(3, required=True)
 
+class CacheStatsForm(messages.Message):
+    """Return cache hit, miss and conflict counters"""
+    hits = messages.IntegerField(1, required=True)
+    misses = messages.IntegerField(2, required=True)
+    conflicts = messages.IntegerField(3, required=True)
+
+
+class RpcStatsForm(messages.Message):
+    """Number and total time of one type of RPC"""
+    rpc_type = messages.StringField(1, required=True)
+    calls = messages.IntegerField(2, required=True)
+    total_ms = messages.IntegerField(3, required=True)
+
+
+class SlowCallForm(messages.Message):
+    """Duration and RPCs of one slow API call"""
+    duration_ms = messages.FloatField(1, required=True)
+    rpcs = messages.MessageField(RpcStatsForm, 2, repeated=True)
+
+
+class EndpointStatsForm(messages.Message):
+    """Aggregated calls, time and RPCs of one endpoint"""
+    endpoint = messages.StringField(1, required=True)
+    calls = messages.IntegerField(2, required=True)
+    total_ms = messages.IntegerField(3, required=True)
+    rpcs = messages.MessageField(RpcStatsForm, 4, repeated=True)
+    slowest = messages.MessageField(SlowCallForm, 5, repeated=True)
+
+
+class ApiStatsForm(messages.Message):
+    """Return stats of all endpoints"""
+    items = messages.MessageField(EndpointStatsForm, 1, repeated=True)
+
+
+class DailyGamesForm(messages.Message):
+    """Number of games created on one day"""
+    date = messages.StringField(1, required=True)
+    games = messages.IntegerField(2, required=True)
+
+
+class GameStatsForm(messages.Message):
+    """Return global game statistics"""
+    active_games = messages.IntegerField(1, required=True)
+    attempts_remaining = messages.IntegerField(2, required=True)
+    average_attempts_remaining = messages.FloatField(3)
+    wins = messages.IntegerField(4, required=True)
+    losses = messages.IntegerField(5, required=True)
+    games_per_day = messages.MessageField(DailyGamesForm, 6, repeated=True)
+
+
+class ReaperStatsForm(messages.Message):
+    """Stats of the last finished run of the abandoned game reaper"""
+    run_id = messages.StringField(1, required=True)
+    ttl_days = messages.IntegerField(2, required=True)
+    pages = messages.IntegerField(3, required=True)
+    archived = messages.IntegerField(4, required=True)
+    duration_s = messages.FloatField(5, required=True)
+    games_per_s = messages.FloatField(6, required=True)
+    backlog = messages.IntegerField(7, required=True)
+
+
+class WindowRankingForm(messages.Message):
+    """Return a user's rank and games in a leaderboard window"""
+    user_name = messages.StringField(1, required=True)
+    window = messages.StringField(2, required=True)
+    rank = messages.IntegerField(3, required=True)
+    best_score = messages.FloatField(4, required=True)
+    games = messages.IntegerField(5, required=True)
+    wins = messages.IntegerField(6, required=True)
+
+
+class StartupPhaseForm(messages.Message):
+    """Duration of one phase of an instance's cold start"""
+    name = messages.StringField(1, required=True)
+    ms = messages.FloatField(2, required=True)
+
+
+class StartupReportForm(messages.Message):
+    """Cold start phases of one instance"""
+    version = messages.StringField(1)
+    instance = messages.StringField(2)
+    trigger = messages.StringField(3, required=True)
+    total_ms = messages.FloatField(4, required=True)
+    phases = messages.MessageField(StartupPhaseForm, 5, repeated=True)
+
+
+class StartupStatsForm(messages.Message):
+    """Return the cold start reports of recent instances"""
+    items = messages.MessageField(StartupReportForm, 1, repeated=True)
 
 
 class StringMessage(messages.Message):
@@ -0,0 +1,95 @@
+"""reaper.py - Archives and deletes unfinished Games that have not been played
+for longer than a time to live. Each run pages through the idle games with a
+chain of tasks in main.py, moving each page into ArchivedGames and deleting
+the Games with their HistoryChunks and GuessReceipts. A run stops after
+MAX_RUN_PAGES pages; whatever is left is reported as the backlog and picked
+up by the next run."""
+
+import json
+import logging
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from game_cache import GameCache
+from models import Game, GameStats, GuessReceipt
+from utils import fetch_page
+
+DEFAULT_TTL_DAYS = 30
+REAP_PAGE_SIZE = 100
+MAX_RUN_PAGES = 50
+# Idle games are counted up to this many when reporting the backlog
+BACKLOG_COUNT_LIMIT = 10000
+LAST_RUN_KEY = 'reaper:last_run'
+
+
+def idle_games_query(cutoff):
+    """Query for unfinished Games last written before cutoff, a datetime"""
+    return Game.query(Game.game_over == False, Game.last_modified < cutoff)
+
+
+def reap_page(cutoff, cursor=None):
+    """Archives and deletes one page of idle Games. Returns the number of
+    games archived and the cursor of the next page, or None.
+
+    The query is eventually consistent, so each game is read again in its
+    own transaction and only archived if it is still unfinished and idle.
+    A game played since the query ran is left alone. The transactions of a
+    page run in parallel."""
+    game_keys, next_cursor = fetch_page(idle_games_query(cutoff),
+                                        REAP_PAGE_SIZE, cursor,
+                                        keys_only=True)
+    futures = [_reap_game_async(key, cutoff) for key in game_keys]
+    games = [game for game in (future.get_result() for future in futures)
+             if game]
+    if games:
+        GameCache().delete_multi([game.key for game in games])
+        GameStats.record_removed(games)
+    return len(games), next_cursor
+
+
+@ndb.transactional_tasklet(xg=True)
+def _reap_game_async(game_key, cutoff):
+    """Archives and deletes a Game with its HistoryChunks and GuessReceipts
+    if it is still unfinished and was last written before cutoff. Returns a
+    future for the Game, or for None if it was not reaped."""
+    game = yield game_key.get_async()
+    if not game or game.game_over or not game.last_modified or \
+            game.last_modified >= cutoff:
+        raise ndb.Return(None)
+    chunk_keys = game.history_chunk_keys()
+    chunks, receipt_keys = yield (
+        ndb.get_multi_async(chunk_keys),
+        GuessReceipt.query(ancestor=game_key).fetch_async(keys_only=True))
+    yield (game.to_archive(chunks).put_async(),
+           ndb.delete_multi_async([game_key] + chunk_keys + receipt_keys))
+    raise ndb.Return(game)
+
+
+def count_backlog(cutoff):
+    """Returns the number of idle Games left, up to BACKLOG_COUNT_LIMIT"""
+    return idle_games_query(cutoff).count(limit=BACKLOG_COUNT_LIMIT)
+
+
+def record_run(run_id, ttl_days, started, pages, archived, backlog):
+    """Logs one reaper_stats line for a finished run and keeps it in
+    memcache for get_reaper_stats"""
+    duration = time.time() - started
+    stats = {
+        'run_id': run_id,
+        'ttl_days': ttl_days,
+        'pages': pages,
+        'archived': archived,
+        'duration_s': round(duration, 2),
+        'games_per_s': round(archived / duration, 2) if duration else 0.0,
+        'backlog': backlog,
+    }
+    logging.info('reaper_stats %s', json.dumps(stats, sort_keys=True))
+    memcache.set(LAST_RUN_KEY, stats)
+    return stats
+
+
+def get_last_run():
+    """Returns the stats of the last finished run, or None"""
+    return memcache.get(LAST_RUN_KEY)
@@ -0,0 +1,76 @@
+"""startup.py - Timing of the phases of an instance's cold start. api.py and
+main.py time their imports, and the warmup request times building the API
+server and priming the caches. The first warmup or API request to finish
+logs the phases as one startup_stats line and keeps them in memcache per app
+version, so that cold-start latency can be compared across releases."""
+
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+from google.appengine.api import memcache
+
+MEMCACHE_PREFIX = 'startup:'
+# Reports of the most recent instances kept per app version
+REPORTS_KEPT = 20
+
+# api.py and main.py import this module before anything else, so this is
+# close to when the instance started loading the app.
+_loaded = time.time()
+_lock = threading.Lock()
+_phases = []
+_reported = False
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Context manager that records how long its block took as phase name"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(name, (time.time() - start) * 1000)
+
+
+def record(name, duration_ms):
+    with _lock:
+        _phases.append((name, duration_ms))
+
+
+def reported():
+    return _reported
+
+
+def report(trigger):
+    """Logs and stores the phases recorded so far, once per instance.
+    trigger names the request that ended the cold start. Returns the report,
+    or None if it was already made."""
+    global _reported
+    with _lock:
+        if _reported:
+            return None
+        _reported = True
+        summary = {
+            'version': os.environ.get('CURRENT_VERSION_ID'),
+            'instance': os.environ.get('INSTANCE_ID'),
+            'trigger': trigger,
+            'total_ms': round((time.time() - _loaded) * 1000, 2),
+            'phases': [{'name': name, 'ms': round(ms, 2)}
+                       for name, ms in _phases],
+        }
+    logging.info('startup_stats %s', json.dumps(summary, sort_keys=True))
+    key = MEMCACHE_PREFIX + str(summary['version'])
+    reports = memcache.get(key) or []
+    reports.append(summary)
+    memcache.set(key, reports[-REPORTS_KEPT:])
+    return summary
+
+
+def get_reports(version=None):
+    """Returns the startup reports of the most recent instances of an app
+    version, this instance's version by default, oldest first"""
+    version = version or os.environ.get('CURRENT_VERSION_ID')
+    return memcache.get(MEMCACHE_PREFIX + str(version)) or []
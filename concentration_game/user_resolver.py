@@ -0,0 +1,156 @@
+"""user_resolver.py - Resolves user names to User keys. Results are cached in
+a small in-process LRU cache backed by memcache, so resolving a popular name
+usually costs no RPC at all."""
+
+import collections
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import User
+
+MEMCACHE_PREFIX = 'user_name:'
+MEMCACHE_TTL = 60 * 60
+LOCAL_CACHE_SIZE = 1000
+# Entries in the in-process cache are trusted for a shorter time than
+# memcache, since other instances cannot invalidate them.
+LOCAL_CACHE_TTL = 5 * 60
+# Names looked up by each query for users not migrated to name keys, the
+# most values an IN filter takes
+LEGACY_QUERY_SIZE = 30
+
+ResolvedUser = collections.namedtuple('ResolvedUser', ['key', 'name'])
+
+
+class LRUCache(object):
+    """Thread-safe least-recently-used cache with a per-entry time to live"""
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.time():
+                return None
+            # Re-insert to mark the entry as most recently used
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + self.ttl)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+_local_cache = LRUCache(LOCAL_CACHE_SIZE, LOCAL_CACHE_TTL)
+
+
+def resolve_user(name):
+    """Returns a ResolvedUser for the user with the given name, or None if no
+    such user exists. Users created before User entities were keyed by name
+    are found with a query until they are migrated."""
+    normalized = User.normalize_name(name)
+    if not normalized:
+        return None
+    resolved = _local_cache.get(normalized)
+    if resolved:
+        return resolved
+
+    cached = memcache.get(MEMCACHE_PREFIX + normalized)
+    if cached:
+        resolved = ResolvedUser(ndb.Key(urlsafe=cached[0]), cached[1])
+    else:
+        user = User.key_for(name).get()
+        if not user:
+            user = User.query(User.name == name).get()
+        if not user:
+            return None
+        resolved = ResolvedUser(user.key, user.name)
+        memcache.set(MEMCACHE_PREFIX + normalized,
+                     (user.key.urlsafe(), user.name), time=MEMCACHE_TTL)
+    _local_cache.set(normalized, resolved)
+    return resolved
+
+
+def resolve_users(names):
+    """Returns a dict mapping each of the given names to a ResolvedUser, or
+    to None if no such user exists or the name is blank. Resolves like
+    resolve_user, but each level is read in one batch: one memcache
+    get_multi, one get_multi for the names not cached and, for the names
+    still not found, parallel queries in case their users are not migrated
+    to name keys yet."""
+    names = set(names)
+    by_normalized = collections.defaultdict(list)
+    for name in names:
+        normalized = User.normalize_name(name)
+        if normalized:
+            by_normalized[normalized].append(name)
+
+    found = {}
+    for normalized in by_normalized:
+        resolved = _local_cache.get(normalized)
+        if resolved:
+            found[normalized] = resolved
+    missing = [name for name in by_normalized if name not in found]
+    if missing:
+        cached = memcache.get_multi(missing, key_prefix=MEMCACHE_PREFIX)
+        for normalized, (urlsafe, user_name) in cached.items():
+            found[normalized] = ResolvedUser(ndb.Key(urlsafe=urlsafe),
+                                             user_name)
+        missing = [name for name in missing if name not in cached]
+
+    loaded = []
+    if missing:
+        loaded = [user for user in ndb.get_multi([User.key_for(name)
+                                                  for name in missing])
+                  if user]
+        keyed = set(user.key.id() for user in loaded)
+        legacy_names = [name for normalized in missing
+                        if normalized not in keyed
+                        for name in by_normalized[normalized]]
+        futures = []
+        for start in range(0, len(legacy_names), LEGACY_QUERY_SIZE):
+            chunk = legacy_names[start:start + LEGACY_QUERY_SIZE]
+            futures.append(User.query(User.name.IN(chunk)).fetch_async())
+        loaded += [user for future in futures
+                   for user in future.get_result()]
+    if loaded:
+        memcache.set_multi(dict((User.normalize_name(user.name),
+                                 (user.key.urlsafe(), user.name))
+                                for user in loaded),
+                           key_prefix=MEMCACHE_PREFIX, time=MEMCACHE_TTL)
+        for user in loaded:
+            found[User.normalize_name(user.name)] = ResolvedUser(user.key,
+                                                                 user.name)
+
+    for normalized, resolved in found.items():
+        _local_cache.set(normalized, resolved)
+    return dict((name, found.get(User.normalize_name(name)))
+                for name in names)
+
+
+def prime(names):
+    """Loads the users with the given names into the in-process cache. Used
+    to warm up a new instance."""
+    resolve_users(names)
+
+
+def forget_user(name):
+    """Drops a name from the caches, e.g. after its User has been re-keyed"""
+    normalized = User.normalize_name(name)
+    _local_cache.delete(normalized)
+    memcache.delete(MEMCACHE_PREFIX + normalized)
@@ -1,29 +1,33 @@
 """utils.py - File for collecting general utility functions."""
 
-import random
 import logging
+import threading
+from google.appengine.api import memcache
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 import endpoints
 
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def key_from_urlsafe(urlsafe, model):
+    """Returns the ndb.Key that a urlsafe key string stands for, without
+    getting the entity. Raises BadRequestException if the string is
+    malformed and ValueError if the key is not of the kind of model."""
+    try:
+        key = ndb.Key(urlsafe=urlsafe)
+    except TypeError:
+        raise endpoints.BadRequestException('Invalid Key')
+    except Exception, e:
+        if e.__class__.__name__ == 'ProtocolBufferDecodeError':
+            raise endpoints.BadRequestException('Invalid Key')
+        else:
+            raise
+    if key.kind() != model._get_kind():
+        raise ValueError('Incorrect Kind')
+    return key
 
-def generate_random_pairs(num_pairs):
-    """Creates and returns a list of integer pairs. The pairs are randomly
-    positioned in the list."""
-    if num_pairs < 2:
-        raise ValueError('Number of the pairs should be greater than 1')
-    available_pairs = []
-    # Generate pairs of integers from 1 to num_pairs
-    for count in range(1, num_pairs + 1):
-        available_pairs += [count, count]
-
-    random_pairs = []
-    # Randomly distribute elements in available_pairs
-    for remaining in range(len(available_pairs), 0, -1):
-        # Random element from available_pairs will be moved to random_pairs
-        random_index = random.randint(0, remaining - 1) 
-        random_pairs.append(available_pairs.pop(random_index))
-        
-    return random_pairs
 
 def get_by_urlsafe(urlsafe, model):
     """Returns an ndb.Model entity that the urlsafe key points to. Checks
@@ -54,3 +58,99 @@ def get_by_urlsafe(urlsafe, model):
     if not isinstance(entity, model):
         raise ValueError('Incorrect Kind')
     return entity
+
+
+def fetch_page(query, page_size=None, urlsafe_cursor=None, **options):
+    """Fetches one page of results for a query using datastore cursors.
+    Args:
+        query: An ndb.Query
+        page_size: Number of results to return. Defaults to DEFAULT_PAGE_SIZE
+            and is capped at MAX_PAGE_SIZE.
+        urlsafe_cursor: An opaque cursor string returned by a previous call,
+            or None to start from the beginning.
+        options: Query options such as keys_only or projection.
+    Returns:
+        A tuple of the list of results and the cursor string for the next
+        page, which is None when there are no more results.
+    Raises:
+        endpoints.BadRequestException: If the cursor or page size is invalid."""
+    if page_size is None:
+        page_size = DEFAULT_PAGE_SIZE
+    if page_size < 1:
+        raise endpoints.BadRequestException('Page size should be at least 1')
+    page_size = min(page_size, MAX_PAGE_SIZE)
+    try:
+        cursor = Cursor(urlsafe=urlsafe_cursor) if urlsafe_cursor else None
+    except Exception:
+        raise endpoints.BadRequestException('Invalid cursor')
+
+    results, next_cursor, more = query.fetch_page(page_size,
+                                                  start_cursor=cursor,
+                                                  **options)
+    if more and next_cursor:
+        return results, next_cursor.urlsafe()
+    return results, None
+
+
+class WriteBatch(object):
+    """Buffers entity writes made while handling a request so that they are
+    sent to the datastore together with a single put_multi_async. An entity
+    added more than once is written once, with its latest state."""
+    def __init__(self):
+        self._entities = []
+
+    def put(self, entity):
+        """Adds an entity to be written when the batch is flushed"""
+        if not any(entity is pending for pending in self._entities):
+            self._entities.append(entity)
+
+    def flush_async(self):
+        """Writes all buffered entities and empties the batch. Returns the
+        list of futures from put_multi_async."""
+        entities, self._entities = self._entities, []
+        if not entities:
+            return []
+        return ndb.put_multi_async(entities)
+
+    def flush(self):
+        """Writes all buffered entities, waits for the writes to finish and
+        returns their keys"""
+        return [future.get_result() for future in self.flush_async()]
+
+
+class BufferedCounters(object):
+    """Named counters shared by all instances through memcache. Increments
+    are buffered per instance and added to memcache with one offset_multi
+    after flush_every increments, so counting costs no RPC per request.
+    Counts are best-effort: buffered increments are lost when an instance
+    shuts down and memcache may evict the counters."""
+    def __init__(self, key_prefix, flush_every=50):
+        self.key_prefix = key_prefix
+        self.flush_every = flush_every
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._events = 0
+
+    def incr(self, name, delta=1):
+        self.incr_multi({name: delta})
+
+    def incr_multi(self, deltas):
+        """Adds each value in the dict deltas to the counter named by its key"""
+        with self._lock:
+            for name, delta in deltas.items():
+                self._pending[name] = self._pending.get(name, 0) + delta
+            self._events += 1
+            if self._events < self.flush_every:
+                return
+            pending, self._pending, self._events = self._pending, {}, 0
+        memcache.offset_multi(pending, key_prefix=self.key_prefix,
+                              initial_value=0)
+
+    def get_multi(self, names):
+        """Returns a dict of the current values of the named counters,
+        including increments this instance has not flushed yet"""
+        with self._lock:
+            pending = dict(self._pending)
+        shared = memcache.get_multi(names, key_prefix=self.key_prefix)
+        return dict((name, shared.get(name, 0) + pending.get(name, 0))
+                    for name in names)